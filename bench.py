@@ -0,0 +1,367 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import socket
+import asyncio
+import logging
+import argparse
+import subprocess
+from collections import Counter
+from datetime import datetime, timezone
+from telegram import Update
+import fakes
+
+# ==================== PURCHASE FUNNEL BENCHMARK ====================
+# Drives simulated users through the real handler graph, against
+# fakes.FakeSupabase and fakes.FakeBotApi, one update at a time per user:
+# /start -> Buy Vouchers -> agree_terms -> have_coupon_no -> ctype_* -> qty_*
+# -> verify_* -> payer name -> screenshot -> admin accept.
+#
+#   python bench.py --users 2000 --concurrency 200 --db-latency 0.02
+#
+# Reports throughput, p50/p95/p99 per step and DB calls per completed order,
+# and writes the results as JSON (bench_results/ by default) for comparing runs.
+ADMIN_ID = 999000001
+FIRST_USER_ID = 100000000
+
+# ==================== QUERY BUDGETS ====================
+# Supabase round-trips each funnel step may make with every cache cold: the
+# settings cache is cleared before each step, so reads its TTL usually hides
+# still count. `python bench.py --budgets` walks one buyer through the funnel,
+# a second one to an admin decline, and the admin panel and My Orders, then
+# exits non-zero when a step's count differs from its budget. Budgets are
+# exact counts: lower one when a change removes a query; raising one should be
+# a deliberate decision.
+BUDGET_ADD_CODES = 2500
+BUDGET_INSERT_CHUNK = 1000
+QUERY_BUDGETS = {
+    "start": 1,  # bot_status
+    "buy_vouchers": 1,
+    "agree_terms": 1,
+    "have_coupon_no": 0,
+    "coupon_type": 1,
+    "quantity": 5,  # bot_status, reserve_coupons, users flush, orders insert, qr_image
+    "verify": 1,
+    "payer_name": 1,
+    "screenshot": 3,  # bot_status, order marked verified, reservation extended
+    "admin_accept": 1,  # allocate_order, one transaction
+    "admin_decline": 2,  # order declined, reservation released
+    "my_orders": 2,  # bot_status, orders select
+    "admin_panel": 1,  # bot_status for the toggle button
+    "admin_stock": 1,  # stock_summary
+    "admin_last10": 1,  # one orders select with the usernames embedded
+    "admin_menu": 0,
+    "admin_add": 3,  # ceil(BUDGET_ADD_CODES / BUDGET_INSERT_CHUNK) upserts
+    "admin_free": 1,  # claim_coupons
+}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the purchase funnel against local stand-ins")
+    parser.add_argument("--users", type=int, default=1000, help="simulated buyers")
+    parser.add_argument("--concurrency", type=int, default=100, help="buyers in the funnel at the same time")
+    parser.add_argument("--qty", type=int, choices=(1, 5, 10, 20), default=1, help="codes per order")
+    parser.add_argument("--db-latency", type=float, default=0.02, help="seconds per Supabase round-trip")
+    parser.add_argument("--db-jitter", type=float, default=0.01, help="extra random Supabase latency, up to this")
+    parser.add_argument("--api-latency", type=float, default=0.03, help="seconds per Bot API call")
+    parser.add_argument("--api-jitter", type=float, default=0.01, help="extra random Bot API latency, up to this")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="result file (default: bench_results/bench-<time>.json)")
+    parser.add_argument("--budgets", action="store_true", help="check QUERY_BUDGETS for one buyer instead")
+    return parser.parse_args(argv)
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def percentile(samples, p):
+    # Nearest-rank, so p100 is the maximum and no value is interpolated
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+def summarize(samples):
+    return {
+        "count": len(samples),
+        "mean_ms": round(sum(samples) / len(samples) * 1000, 2),
+        "p50_ms": round(percentile(samples, 50) * 1000, 2),
+        "p95_ms": round(percentile(samples, 95) * 1000, 2),
+        "p99_ms": round(percentile(samples, 99) * 1000, 2),
+        "max_ms": round(max(samples) * 1000, 2),
+    }
+
+def configure(api_port):
+    # bot.py reads its config at import time, so this has to run first. The
+    # Bot API and persistence backend are always the local ones.
+    os.environ.setdefault("TELEGRAM_TOKEN", "123456:bench")
+    os.environ.setdefault("SUPABASE_URL", "https://bench.supabase.co")
+    os.environ.setdefault("SUPABASE_KEY", "bench.bench.bench")
+    os.environ.setdefault("WEBHOOK_URL", "https://bench.invalid")
+    os.environ.setdefault("SINGLE_INSTANCE", "1")
+    os.environ["ADMIN_IDS"] = str(ADMIN_ID)
+    os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{api_port}/bot"
+    os.environ["PERSISTENCE_BACKEND"] = "supabase"
+
+class Funnel:
+    def __init__(self, application, coupon_types, qty):
+        self.app = application
+        self.coupon_types = coupon_types
+        self.qty = qty
+        self.timings = {}
+        self.errors = Counter()
+        self._update_id = 0
+        self._message_id = 0
+        application.add_error_handler(self.on_error)
+
+    async def on_error(self, update, context):
+        self.errors[type(context.error).__name__] += 1
+
+    def _next_ids(self):
+        self._update_id += 1
+        self._message_id += 1
+        return self._update_id, self._message_id
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+    def message(self, user_id, text=None, photo=False):
+        update_id, message_id = self._next_ids()
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+        }
+        if text is not None:
+            message["text"] = text
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        if photo:
+            message["photo"] = [{"file_id": f"photo{message_id}", "file_unique_id": f"u{message_id}", "width": 800, "height": 600}]
+        return Update.de_json({"update_id": update_id, "message": message}, self.app.bot)
+
+    def callback(self, user_id, data):
+        update_id, message_id = self._next_ids()
+        return Update.de_json({"update_id": update_id, "callback_query": {
+            "id": str(update_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "from": self._user(user_id),
+            "message": {"message_id": message_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"}, "text": "…"},
+        }}, self.app.bot)
+
+    async def step(self, name, update):
+        # Same path as an update taken off the queue: through the update
+        # processor, so per-chat ordering and the concurrency limit apply
+        start = time.perf_counter()
+        await self.app.update_processor.process_update(update, self.app.process_update(update))
+        self.timings.setdefault(name, []).append(time.perf_counter() - start)
+
+    async def buyer(self, user_id, rng):
+        order_id = await self.checkout(user_id, rng)
+        if order_id:
+            await self.step("admin_accept", self.callback(ADMIN_ID, f"accept_{order_id}"))
+
+    async def checkout(self, user_id, rng):
+        # Everything up to the payment screenshot; returns the order id
+        ctype = rng.choice(self.coupon_types)
+        await self.step("start", self.message(user_id, "/start"))
+        await self.step("buy_vouchers", self.message(user_id, "🛒 Buy Vouchers"))
+        await self.step("agree_terms", self.callback(user_id, "agree_terms"))
+        await self.step("have_coupon_no", self.callback(user_id, "have_coupon_no"))
+        await self.step("coupon_type", self.callback(user_id, f"ctype_{ctype}"))
+        await self.step("quantity", self.callback(user_id, f"qty_{self.qty}"))
+        order_id = self.app.user_data.get(user_id, {}).get("order_id")
+        if not order_id:
+            self.errors["no_order"] += 1
+            return None
+        await self.step("verify", self.callback(user_id, f"verify_{order_id}"))
+        await self.step("payer_name", self.message(user_id, f"Payer {user_id}"))
+        await self.step("screenshot", self.message(user_id, photo=True))
+        return order_id
+
+class BudgetFunnel(Funnel):
+    def __init__(self, application, coupon_types, qty, supabase, settings):
+        super().__init__(application, coupon_types, qty)
+        self.supabase = supabase
+        self.settings = settings
+        self.queries = {}
+
+    async def step(self, name, update):
+        self.settings.invalidate_settings()
+        before = Counter(self.supabase.calls)
+        await super().step(name, update)
+        calls = self.supabase.calls - before
+        # A step run more than once is held to its most expensive run
+        if sum(calls.values()) >= sum(self.queries.get(name, Counter()).values()):
+            self.queries[name] = calls
+
+    async def others(self, buyer_id, decliner_id, rng):
+        # The menu and admin actions outside the purchase funnel
+        await self.step("my_orders", self.message(buyer_id, "📦 My Orders"))
+        order_id = await self.checkout(decliner_id, rng)
+        if order_id:
+            await self.step("admin_decline", self.callback(ADMIN_ID, f"decline_{order_id}"))
+        await self.step("admin_panel", self.message(ADMIN_ID, "/admin"))
+        await self.step("admin_stock", self.callback(ADMIN_ID, "admin_stock"))
+        await self.step("admin_last10", self.callback(ADMIN_ID, "admin_last10"))
+        ctype = self.coupon_types[0]
+        await self.step("admin_menu", self.callback(ADMIN_ID, f"admin_add_{ctype}"))
+        codes = "\n".join(f"ADDED{ctype}-{i:07d}" for i in range(BUDGET_ADD_CODES))
+        await self.step("admin_add", self.message(ADMIN_ID, codes))
+        await self.step("admin_menu", self.callback(ADMIN_ID, f"admin_free_{ctype}"))
+        await self.step("admin_free", self.message(ADMIN_ID, "2"))
+
+def setup(args):
+    # Returns the bot module, a seeded FakeSupabase and a FakeBotApi, with the
+    # bot wired to both. Must be called from inside the event loop.
+    api_port = _free_port()
+    configure(api_port)
+    import db
+    supabase = fakes.FakeSupabase(latency=args.db_latency, jitter=args.db_jitter)
+    db.use_client(supabase)
+    import bot
+    logging.getLogger().setLevel(logging.WARNING)
+
+    supabase.load("prices", [
+        {"coupon_type": ct, "price_1": 100, "price_5": 95, "price_10": 90, "price_20": 85, "min_quantity": 1}
+        for ct in bot.COUPON_TYPES
+    ])
+    supabase.load("coupons", [
+        {"code": f"BENCH{ct}-{i:07d}", "type": ct}
+        for ct in bot.COUPON_TYPES for i in range(args.users * args.qty)
+    ])
+    api = fakes.FakeBotApi(latency=args.api_latency, jitter=args.api_jitter).start(api_port)
+    return bot, supabase, api
+
+async def run(args):
+    bot, supabase, api = setup(args)
+    application = bot.application
+    funnel = Funnel(application, bot.COUPON_TYPES, args.qty)
+
+    await application.initialize()
+    await bot.post_init(application)
+    await application.start()
+    db_before, api_before = sum(supabase.calls.values()), len(api.calls)
+    calls_before = Counter(supabase.calls)
+
+    rng = random.Random(args.seed)
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def buyer(user_id):
+        async with slots:
+            await funnel.buyer(user_id, random.Random(rng.random()))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(buyer(FIRST_USER_ID + i) for i in range(args.users)))
+    wall = time.perf_counter() - start
+
+    db_calls = sum(supabase.calls.values()) - db_before
+    api_calls = len(api.calls) - api_before
+    per_op = supabase.calls - calls_before
+    completed = sum(1 for o in supabase.tables["orders"] if o["status"] == "completed")
+
+    await bot.post_stop(application)
+    await application.stop()
+    await application.shutdown()
+    await bot.post_shutdown(application)
+    api.stop()
+
+    orders = max(completed, 1)
+    updates = sum(len(t) for t in funnel.timings.values())
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": _commit(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "budgets")},
+        "wall_seconds": round(wall, 3),
+        "orders_completed": completed,
+        "orders_per_second": round(completed / wall, 2),
+        "updates_per_second": round(updates / wall, 2),
+        "db_calls_per_order": round(db_calls / orders, 2),
+        "bot_api_calls_per_order": round(api_calls / orders, 2),
+        "db_calls_by_operation": {
+            f"{table} {op}": round(count / orders, 3) for (table, op), count in sorted(per_op.items())
+        },
+        "errors": dict(funnel.errors),
+        "steps": {name: summarize(samples) for name, samples in funnel.timings.items()},
+    }
+
+async def check_budgets(args):
+    # No latency and no application.start(), so background jobs and
+    # persistence writes stay out of the per-step counts
+    args.users = 5  # enough seeded stock for both buyers and the free codes
+    args.db_latency = args.db_jitter = args.api_latency = args.api_jitter = 0
+    os.environ["PERSISTENCE_REFRESH"] = "0"  # the store read is not the handlers' own
+    bot, supabase, api = setup(args)
+    bot.db.COUPON_INSERT_CHUNK = BUDGET_INSERT_CHUNK
+    application = bot.application
+    funnel = BudgetFunnel(application, bot.COUPON_TYPES, args.qty, supabase, bot.db)
+
+    await application.initialize()
+    await bot.post_init(application)
+    rng = random.Random(args.seed)
+    await funnel.buyer(FIRST_USER_ID, rng)
+    await funnel.others(FIRST_USER_ID, FIRST_USER_ID + 1, rng)
+    await application.shutdown()
+    await bot.post_shutdown(application)
+    api.stop()
+    return funnel
+
+def report_budgets(funnel):
+    over = 0
+    print(f"{'step':<16}{'queries':>8}{'budget':>8}")
+    for name, budget in QUERY_BUDGETS.items():
+        calls = funnel.queries.get(name)
+        if calls is None:
+            print(f"{name:<16}{'-':>8}{budget:>8}  not reached")
+            over += 1
+            continue
+        total = sum(calls.values())
+        detail = ", ".join(f"{table} {op} x{n}" for (table, op), n in sorted(calls.items()))
+        if total > budget:
+            over += 1
+            print(f"{name:<16}{total:>8}{budget:>8}  OVER BUDGET: {detail}")
+        elif total < budget:
+            over += 1
+            print(f"{name:<16}{total:>8}{budget:>8}  UNDER BUDGET, lower it: {detail}")
+        else:
+            print(f"{name:<16}{total:>8}{budget:>8}  {detail}")
+    if funnel.errors:
+        print(f"Errors: {dict(funnel.errors)}")
+    return 1 if over or funnel.errors else 0
+
+def report(result):
+    print(f"{result['orders_completed']} orders in {result['wall_seconds']}s "
+          f"({result['orders_per_second']} orders/s, {result['updates_per_second']} updates/s)")
+    print(f"DB calls per order: {result['db_calls_per_order']}, "
+          f"Bot API calls per order: {result['bot_api_calls_per_order']}")
+    if result["errors"]:
+        print(f"Errors: {result['errors']}")
+    print(f"{'step':<16}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, s in result["steps"].items():
+        print(f"{name:<16}{s['p50_ms']:>10}{s['p95_ms']:>10}{s['p99_ms']:>10}{s['max_ms']:>10}")
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.budgets:
+        return report_budgets(asyncio.run(check_budgets(args)))
+    result = asyncio.run(run(args))
+    report(result)
+    out = args.out or os.path.join("bench_results", f"bench-{result['timestamp'].replace(':', '')}.json")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"Saved {out}")
+    return 1 if result["errors"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,33 +1,47 @@
 import os
+import time
+import signal
+import asyncio
 import logging
 import random
 import string
 from datetime import datetime
-from flask import Flask, request
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler, MessageHandler,
     filters, ContextTypes, ConversationHandler
 )
-from supabase import create_client, Client
+import db
+import broadcast
+from persistence import create_persistence
+from server import start_server, WEBHOOK_SECRET
+from processor import PerChatUpdateProcessor
+from metrics import timed, TimedRequest
 
 # ==================== CONFIG ====================
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN")
-SUPABASE_URL = os.environ.get("SUPABASE_URL")
-SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org/bot")
 ADMIN_IDS = [int(id) for id in os.environ.get("ADMIN_IDS", "8537079657").split(",")]
 
 WEBHOOK_URL = os.environ.get("WEBHOOK_URL") or os.environ.get("RENDER_EXTERNAL_URL")
 if not WEBHOOK_URL:
     raise ValueError("WEBHOOK_URL or RENDER_EXTERNAL_URL must be set")
-
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+PORT = int(os.environ.get("PORT", 5000))
+# 0-1023 and unique per running instance, or two instances can mint the same
+# order id. Must be set explicitly unless SINGLE_INSTANCE=1, which defaults it to 0.
+SINGLE_INSTANCE = os.environ.get("SINGLE_INSTANCE") == "1"
+if "WORKER_ID" not in os.environ and not SINGLE_INSTANCE:
+    raise ValueError("WORKER_ID must be set (0-1023, unique per instance), or SINGLE_INSTANCE=1 for one instance")
+WORKER_ID = int(os.environ.get("WORKER_ID", 0))
+if not 0 <= WORKER_ID < 1024:
+    raise ValueError(f"WORKER_ID must be between 0 and 1023, got {WORKER_ID}")
 
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # ==================== CONSTANTS ====================
 COUPON_TYPES = ["500", "1000", "2000", "4000"]
+MAX_CODE_LENGTH = 64
 
 # Conversation states
 SELECTING_COUPON_TYPE, SELECTING_QUANTITY, CUSTOM_QUANTITY = range(3)
@@ -38,10 +52,280 @@ ENTER_COUPON = 5
 """
 -- Add discount_code column to orders
 ALTER TABLE orders ADD COLUMN discount_code TEXT;
+
+-- Lets "Last 10 Purchases" embed the buyer's username in the orders query
+ALTER TABLE orders ADD CONSTRAINT orders_user_id_fkey FOREIGN KEY (user_id) REFERENCES users (user_id);
+
+-- Coupon codes are unique so bulk restocks can skip duplicates server-side
+CREATE UNIQUE INDEX IF NOT EXISTS coupons_code_key ON coupons (code);
+
+-- Pending orders soft-reserve their codes until reserved_until; a code is
+-- available when it is unused and has no live reservation
+ALTER TABLE coupons ADD COLUMN IF NOT EXISTS reserved_for TEXT;
+ALTER TABLE coupons ADD COLUMN IF NOT EXISTS reserved_until TIMESTAMPTZ;
+CREATE INDEX IF NOT EXISTS coupons_reserved_for_idx ON coupons (reserved_for) WHERE reserved_for IS NOT NULL;
+CREATE INDEX IF NOT EXISTS coupons_reserved_until_idx ON coupons (reserved_until) WHERE reserved_until IS NOT NULL;
+
+-- Available stock and base price for every coupon type in one round-trip
+CREATE INDEX IF NOT EXISTS coupons_available_idx ON coupons (type) WHERE is_used = FALSE;
+
+CREATE OR REPLACE FUNCTION stock_summary()
+RETURNS TABLE (coupon_type TEXT, available BIGINT, price_1 NUMERIC)
+LANGUAGE sql STABLE AS $$
+    SELECT p.coupon_type::TEXT, COUNT(c.id), p.price_1::NUMERIC
+    FROM prices p
+    LEFT JOIN coupons c ON c.type = p.coupon_type AND c.is_used = FALSE
+        AND (c.reserved_until IS NULL OR c.reserved_until < NOW())
+    GROUP BY p.coupon_type, p.price_1;
+$$;
+
+-- Open holds are counted per buyer from their orders
+CREATE INDEX IF NOT EXISTS orders_user_id_idx ON orders (user_id);
+
+-- Reserves p_quantity available codes for an order until p_ttl_seconds from
+-- now. All or nothing: returns 'insufficient_stock' and reserves nothing if
+-- stock is short, and 'too_many_open' if p_user_id already has p_max_open
+-- orders holding codes. Returns 'reserved' otherwise.
+DROP FUNCTION IF EXISTS reserve_coupons(TEXT, TEXT, INT, INT);
+CREATE OR REPLACE FUNCTION reserve_coupons(
+    p_order_id TEXT, p_user_id BIGINT, p_type TEXT, p_quantity INT, p_ttl_seconds INT, p_max_open INT
+)
+RETURNS TEXT
+LANGUAGE plpgsql AS $$
+DECLARE
+    reserved INT;
+    open_orders INT;
+BEGIN
+    SELECT COUNT(DISTINCT c.reserved_for) INTO open_orders
+    FROM orders o JOIN coupons c ON c.reserved_for = o.order_id
+    WHERE o.user_id = p_user_id AND c.is_used = FALSE AND c.reserved_until > NOW();
+    IF open_orders >= p_max_open THEN
+        RETURN 'too_many_open';
+    END IF;
+    BEGIN
+        WITH picked AS (
+            SELECT id FROM coupons
+            WHERE type = p_type AND is_used = FALSE
+                AND (reserved_until IS NULL OR reserved_until < NOW())
+            ORDER BY id
+            LIMIT p_quantity
+            FOR UPDATE SKIP LOCKED
+        ), held AS (
+            UPDATE coupons c
+            SET reserved_for = p_order_id, reserved_until = NOW() + make_interval(secs => p_ttl_seconds)
+            FROM picked WHERE c.id = picked.id
+            RETURNING c.id
+        )
+        SELECT COUNT(*) INTO reserved FROM held;
+        IF reserved < p_quantity THEN
+            RAISE EXCEPTION 'insufficient_stock';
+        END IF;
+    EXCEPTION WHEN raise_exception THEN
+        RETURN 'insufficient_stock';
+    END;
+    RETURN 'reserved';
+END;
+$$;
+
+-- Clears up to p_limit expired reservations and returns how many codes went
+-- back to each coupon type, e.g. {"500": 3}
+CREATE OR REPLACE FUNCTION release_expired_reservations(p_limit INT)
+RETURNS JSONB
+LANGUAGE sql AS $$
+    WITH expired AS (
+        SELECT id FROM coupons
+        WHERE reserved_until < NOW() AND is_used = FALSE
+        ORDER BY reserved_until
+        LIMIT p_limit
+        FOR UPDATE SKIP LOCKED
+    ), released AS (
+        UPDATE coupons c SET reserved_for = NULL, reserved_until = NULL
+        FROM expired WHERE c.id = expired.id
+        RETURNING c.type
+    )
+    SELECT COALESCE(jsonb_object_agg(type, n), '{}'::JSONB)
+    FROM (SELECT type, COUNT(*) AS n FROM released GROUP BY type) counts;
+$$;
+
+-- Marks p_quantity unused coupons of a type as used by p_user_id and returns
+-- their codes. SKIP LOCKED keeps concurrent claims from handing out the same
+-- rows. All or nothing: returns NULL and claims nothing if stock is short.
+CREATE OR REPLACE FUNCTION claim_coupons(p_type TEXT, p_quantity INT, p_user_id BIGINT)
+RETURNS TEXT[]
+LANGUAGE plpgsql AS $$
+DECLARE
+    claimed TEXT[];
+BEGIN
+    BEGIN
+        WITH picked AS (
+            SELECT id FROM coupons
+            WHERE type = p_type AND is_used = FALSE
+                AND (reserved_until IS NULL OR reserved_until < NOW())
+            ORDER BY id
+            LIMIT p_quantity
+            FOR UPDATE SKIP LOCKED
+        ), used AS (
+            UPDATE coupons c
+            SET is_used = TRUE, used_by = p_user_id, used_at = NOW(), reserved_for = NULL, reserved_until = NULL
+            FROM picked WHERE c.id = picked.id
+            RETURNING c.code
+        )
+        SELECT array_agg(code) INTO claimed FROM used;
+        IF COALESCE(cardinality(claimed), 0) < p_quantity THEN
+            RAISE EXCEPTION 'insufficient_stock';
+        END IF;
+    EXCEPTION WHEN raise_exception THEN
+        RETURN NULL;
+    END;
+    RETURN claimed;
+END;
+$$;
+
+-- Accepts a pending order atomically: locks the order, hands over the codes
+-- reserved for it and completes the order in one transaction. If the
+-- reservation lapsed and some of its codes went to other orders, whatever is
+-- left of it is released and fresh codes are claimed instead.
+-- Returns {status, codes, user_id, coupon_type, from_reservation, released}.
+CREATE OR REPLACE FUNCTION allocate_order(p_order_id TEXT)
+RETURNS JSONB
+LANGUAGE plpgsql AS $$
+DECLARE
+    o orders%ROWTYPE;
+    claimed TEXT[];
+    held INT;
+    released INT := 0;
+BEGIN
+    SELECT * INTO o FROM orders WHERE order_id = p_order_id FOR UPDATE;
+    IF NOT FOUND THEN
+        RETURN jsonb_build_object('status', 'not_found');
+    END IF;
+    IF o.status <> 'pending' THEN
+        RETURN jsonb_build_object('status', o.status);
+    END IF;
+
+    SELECT COUNT(*) INTO held FROM (
+        SELECT id FROM coupons WHERE reserved_for = p_order_id AND is_used = FALSE FOR UPDATE
+    ) mine;
+    IF held >= o.quantity THEN
+        WITH used AS (
+            UPDATE coupons
+            SET is_used = TRUE, used_by = o.user_id, used_at = NOW(), reserved_for = NULL, reserved_until = NULL
+            WHERE reserved_for = p_order_id AND is_used = FALSE
+            RETURNING code
+        )
+        SELECT array_agg(code) INTO claimed FROM used;
+    ELSE
+        UPDATE coupons SET reserved_for = NULL, reserved_until = NULL
+        WHERE reserved_for = p_order_id AND is_used = FALSE;
+        released := held;
+        claimed := claim_coupons(o.coupon_type, o.quantity, o.user_id);
+        IF claimed IS NULL THEN
+            RETURN jsonb_build_object('status', 'insufficient_stock');
+        END IF;
+    END IF;
+
+    -- The discount code's use was already taken by reserve_discount() at order creation
+    UPDATE orders SET status = 'completed' WHERE order_id = p_order_id;
+
+    RETURN jsonb_build_object(
+        'status', 'completed',
+        'codes', to_jsonb(claimed),
+        'user_id', o.user_id,
+        'coupon_type', o.coupon_type,
+        'from_reservation', held >= o.quantity,
+        'released', released
+    );
+END;
+$$;
+
+-- Set when the buyer submits the payment screenshot; such an order is waiting
+-- for an admin, not abandoned
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS verified_at TIMESTAMPTZ;
+
+-- Moves up to p_limit orders that have been pending for longer than
+-- p_max_age_seconds without a payment screenshot to 'expired', releasing
+-- their coupon reservations and discount uses. Returns {orders, released, discount_codes}.
+DROP INDEX IF EXISTS orders_pending_idx;
+CREATE INDEX IF NOT EXISTS orders_unverified_idx ON orders (created_at) WHERE status = 'pending' AND verified_at IS NULL;
+
+CREATE OR REPLACE FUNCTION expire_pending_orders(p_max_age_seconds INT, p_limit INT)
+RETURNS JSONB
+LANGUAGE sql AS $$
+    WITH stale AS (
+        SELECT order_id FROM orders
+        WHERE status = 'pending' AND verified_at IS NULL
+            AND created_at < NOW() - make_interval(secs => p_max_age_seconds)
+        ORDER BY created_at
+        LIMIT p_limit
+        FOR UPDATE SKIP LOCKED
+    ), expired AS (
+        UPDATE orders o SET status = 'expired'
+        FROM stale WHERE o.order_id = stale.order_id
+        RETURNING o.order_id, o.discount_code
+    ), released AS (
+        UPDATE coupons c SET reserved_for = NULL, reserved_until = NULL
+        FROM expired WHERE c.reserved_for = expired.order_id AND c.is_used = FALSE
+        RETURNING c.type
+    ), discount_uses AS (
+        SELECT discount_code, COUNT(*) AS n FROM expired
+        WHERE discount_code IS NOT NULL GROUP BY discount_code
+    ), returned AS (
+        UPDATE discount_codes d SET uses = GREATEST(d.uses - discount_uses.n, 0), used = FALSE
+        FROM discount_uses WHERE d.code = discount_uses.discount_code
+        RETURNING d.code
+    )
+    SELECT jsonb_build_object(
+        'orders', (SELECT COALESCE(jsonb_agg(order_id), '[]'::JSONB) FROM expired),
+        'released', (
+            SELECT COALESCE(jsonb_object_agg(type, n), '{}'::JSONB)
+            FROM (SELECT type, COUNT(*) AS n FROM released GROUP BY type) counts
+        ),
+        'discount_codes', (SELECT COALESCE(jsonb_agg(code), '[]'::JSONB) FROM returned)
+    );
+$$;
+
+-- Discount codes can be used max_uses times until expires_at (NULL: never);
+-- uses is taken when an order is created and given back when it is declined
+-- or expires
+ALTER TABLE discount_codes ADD COLUMN IF NOT EXISTS max_uses INT NOT NULL DEFAULT 1;
+ALTER TABLE discount_codes ADD COLUMN IF NOT EXISTS expires_at TIMESTAMPTZ;
+ALTER TABLE discount_codes ADD COLUMN IF NOT EXISTS uses INT NOT NULL DEFAULT 0;
+UPDATE discount_codes SET uses = max_uses WHERE used = TRUE;
+
+-- Returns the discount value, or NULL if the code is unknown, used up or expired
+CREATE OR REPLACE FUNCTION reserve_discount(p_code TEXT)
+RETURNS NUMERIC
+LANGUAGE sql AS $$
+    UPDATE discount_codes
+    SET uses = uses + 1, used = (uses + 1 >= max_uses)
+    WHERE code = p_code AND uses < max_uses AND (expires_at IS NULL OR expires_at > NOW())
+    RETURNING value::NUMERIC;
+$$;
+
+CREATE OR REPLACE FUNCTION release_discount(p_code TEXT)
+RETURNS VOID
+LANGUAGE sql AS $$
+    UPDATE discount_codes SET uses = GREATEST(uses - 1, 0), used = FALSE WHERE code = p_code;
+$$;
 """
 
 # ==================== HELPER FUNCTIONS ====================
+# Keyboards and semi-static texts are built once and reused. Each template
+# remembers the versions (price catalog, stock, ...) it was rendered from and
+# is rebuilt only when one of them changes; telegram objects are immutable, so
+# the same markup can be sent to every user.
+_render_cache = {}
+
+def rendered(template, versions, build):
+    cached = _render_cache.get(template)
+    if cached is None or cached[0] != versions:
+        cached = _render_cache[template] = (versions, build())
+    return cached[1]
+
 def get_main_menu():
+    return rendered("main_menu", (), _build_main_menu)
+
+def _build_main_menu():
     keyboard = [
         [KeyboardButton("🛒 Buy Vouchers")],
         [KeyboardButton("📦 My Orders")],
@@ -51,6 +335,9 @@ def get_main_menu():
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
 def get_agree_decline_keyboard():
+    return rendered("agree_decline", (), _build_agree_decline_keyboard)
+
+def _build_agree_decline_keyboard():
     keyboard = [
         [InlineKeyboardButton("✅ Agree", callback_data="agree_terms")],
         [InlineKeyboardButton("❌ Decline", callback_data="decline_terms")]
@@ -58,22 +345,29 @@ def get_agree_decline_keyboard():
     return InlineKeyboardMarkup(keyboard)
 
 def get_coupon_type_keyboard():
+    return rendered("coupon_type", (), _build_coupon_type_keyboard)
+
+def _build_coupon_type_keyboard():
     keyboard = []
     for ct in COUPON_TYPES:
         keyboard.append([InlineKeyboardButton(f"{ct} Off", callback_data=f"ctype_{ct}")])
     return InlineKeyboardMarkup(keyboard)
 
 def get_min_quantity(coupon_type):
-    result = supabase.table("prices").select("min_quantity").eq("coupon_type", coupon_type).execute()
-    if result.data and result.data[0].get("min_quantity") is not None:
-        return result.data[0]["min_quantity"]
+    p = db.price_catalog.get(coupon_type)
+    if p and p.get("min_quantity") is not None:
+        return p["min_quantity"]
     return 1
 
 def get_quantity_keyboard(coupon_type):
-    prices = supabase.table("prices").select("*").eq("coupon_type", coupon_type).execute()
-    if not prices.data:
+    return rendered(
+        f"quantity_{coupon_type}", (db.price_catalog.version,), lambda: _build_quantity_keyboard(coupon_type)
+    )
+
+def _build_quantity_keyboard(coupon_type):
+    p = db.price_catalog.get(coupon_type)
+    if not p:
         return InlineKeyboardMarkup([[InlineKeyboardButton("Error", callback_data="error")]])
-    p = prices.data[0]
     min_qty = p.get("min_quantity", 1)
     keyboard = []
     if min_qty <= 1:
@@ -87,15 +381,56 @@ def get_quantity_keyboard(coupon_type):
     keyboard.append([InlineKeyboardButton("Custom Qty", callback_data="qty_custom")])
     return InlineKeyboardMarkup(keyboard)
 
+def get_stock_message():
+    return rendered("stock_message", (db.price_catalog.version, db.stock.version), _build_stock_message)
+
+def _build_stock_message():
+    stock_msg = "✏️ GaganXShein CODE SHOP\n━━━━━━━━━━━━━━\n📊 Current Stock\n\n"
+    for ct in COUPON_TYPES:
+        price = db.price_catalog.get(ct)
+        price_val = price["price_1"] if price else "N/A"
+        stock_msg += f"▫️ {ct} Off: {db.stock.get(ct)} left (₹{price_val})\n"
+    return stock_msg
+
+def get_coupon_type_message(coupon_type):
+    return rendered(
+        f"coupon_type_{coupon_type}", (db.price_catalog.version, db.stock.version),
+        lambda: (
+            f"🏷️ {coupon_type} Off\n📦 Available stock: {db.stock.get(coupon_type)}\n"
+            f"⚠️ Minimum quantity: {get_min_quantity(coupon_type)}\n\n📋 Available Packages (per-code):"
+        )
+    )
+
+# Snowflake-style ids: 41 bits of milliseconds since ORDER_ID_EPOCH, 10 bits of
+# WORKER_ID and a 12-bit sequence within the millisecond. They never collide
+# across instances, and zero-padding keeps string order equal to creation
+# order so inserts land at the end of the orders index.
+ORDER_ID_EPOCH = 1704067200000  # 2024-01-01 UTC
+_order_id_ms = 0
+_order_id_seq = 0
+
 def generate_order_id():
-    return "ORD" + "".join(random.choices(string.digits, k=14))
+    global _order_id_ms, _order_id_seq
+    # Never step backwards, even if the wall clock does
+    now = max(int(time.time() * 1000), _order_id_ms)
+    if now == _order_id_ms:
+        _order_id_seq = (_order_id_seq + 1) & 0xFFF
+        if _order_id_seq == 0:
+            now += 1  # sequence exhausted, borrow the next millisecond
+    else:
+        _order_id_seq = 0
+    _order_id_ms = now
+    snowflake = ((now - ORDER_ID_EPOCH) << 22) | (WORKER_ID << 12) | _order_id_seq
+    return f"ORD{snowflake:019d}"
 
 def generate_discount_code():
     return "".join(random.choices(string.ascii_uppercase + string.digits, k=8))
 
-def get_admin_panel_keyboard():
-    status = supabase.table("settings").select("value").eq("key", "bot_status").execute()
-    current = status.data[0]["value"] if status.data else "on"
+async def get_admin_panel_keyboard():
+    current = await db.get_setting("bot_status", "on")
+    return rendered("admin_panel", (current,), lambda: _build_admin_panel_keyboard(current))
+
+def _build_admin_panel_keyboard(current):
     status_text = "🔛 Turn Off" if current == "on" else "🔴 Turn On"
     keyboard = [
         [InlineKeyboardButton("➕ Add Coupon", callback_data="admin_add")],
@@ -113,6 +448,9 @@ def get_admin_panel_keyboard():
     return InlineKeyboardMarkup(keyboard)
 
 def get_coupon_type_admin_keyboard(action):
+    return rendered(f"coupon_type_admin_{action}", (), lambda: _build_coupon_type_admin_keyboard(action))
+
+def _build_coupon_type_admin_keyboard(action):
     keyboard = []
     for ct in COUPON_TYPES:
         keyboard.append([InlineKeyboardButton(f"{ct} Off", callback_data=f"admin_{action}_{ct}")])
@@ -123,8 +461,7 @@ async def check_bot_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     user = update.effective_user
     if user.id in ADMIN_IDS:
         return True
-    status = supabase.table("settings").select("value").eq("key", "bot_status").execute()
-    if status.data and status.data[0]["value"] == "off":
+    if await db.get_setting("bot_status") == "off":
         if update.callback_query:
             await update.callback_query.answer("⚠️ Bot is offline for maintenance.", show_alert=True)
         else:
@@ -133,27 +470,17 @@ async def check_bot_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     return True
 
 # ==================== HANDLERS ====================
+@timed
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await check_bot_status(update, context):
         return
     context.user_data.clear()
     user = update.effective_user
-    supabase.table("users").upsert({
-        "user_id": user.id,
-        "username": user.username,
-        "first_name": user.first_name
-    }).execute()
-
-    stock_msg = "✏️ GaganXShein CODE SHOP\n━━━━━━━━━━━━━━\n📊 Current Stock\n\n"
-    for ct in COUPON_TYPES:
-        count = supabase.table("coupons").select("*", count="exact").eq("type", ct).eq("is_used", False).execute()
-        stock = count.count if hasattr(count, "count") else 0
-        price = supabase.table("prices").select("price_1").eq("coupon_type", ct).execute()
-        price_val = price.data[0]["price_1"] if price.data else "N/A"
-        stock_msg += f"▫️ {ct} Off: {stock} left (₹{price_val})\n"
+    db.users.note(user.id, user.username, user.first_name)
 
-    await update.message.reply_text(stock_msg, reply_markup=get_main_menu())
+    await update.message.reply_text(get_stock_message(), reply_markup=get_main_menu())
 
+@timed
 async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await check_bot_status(update, context):
         return
@@ -178,12 +505,12 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         await update.message.reply_text(terms, reply_markup=get_agree_decline_keyboard())
     elif text == "📦 My Orders":
-        orders = supabase.table("orders").select("*").eq("user_id", user.id).order("created_at", desc=True).limit(10).execute()
-        if not orders.data:
+        orders = await db.get_user_orders(user.id)
+        if not orders:
             await update.message.reply_text("You have no orders yet.")
         else:
             msg = "Your last orders:\n"
-            for o in orders.data:
+            for o in orders:
                 msg += f"Order {o['order_id']}: {o['coupon_type']} x{o['quantity']} - {o['status']}\n"
             await update.message.reply_text(msg)
     elif text == "📜 Disclaimer":
@@ -206,6 +533,7 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Use the menu buttons.")
 
 # --- Terms callback ---
+@timed
 async def terms_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await check_bot_status(update, context):
         return
@@ -221,6 +549,7 @@ async def terms_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("Thanks for using the bot. Goodbye!")
 
 # --- Coupon handling ---
+@timed
 async def have_coupon_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -231,45 +560,42 @@ async def have_coupon_callback(update: Update, context: ContextTypes.DEFAULT_TYP
         await query.edit_message_text("🛒 Select a coupon type:", reply_markup=get_coupon_type_keyboard())
         return ConversationHandler.END
 
+@timed
 async def enter_coupon_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await check_bot_status(update, context):
         return ConversationHandler.END
+    if db.discounts.is_throttled(update.effective_user.id):
+        await update.message.reply_text("Too many invalid coupon attempts. Please try again later. Continuing without discount.")
+        await update.message.reply_text("🛒 Select a coupon type:", reply_markup=get_coupon_type_keyboard())
+        return ConversationHandler.END
     code = update.message.text.strip().upper()
-    discount = supabase.table("discount_codes").select("*").eq("code", code).eq("used", False).execute()
-    if discount.data:
-        expires = discount.data[0].get("expires_at")
-        if expires and datetime.fromisoformat(expires) < datetime.utcnow():
-            await update.message.reply_text("This coupon has expired.")
-        else:
-            context.user_data["discount_code"] = code
-            context.user_data["discount_value"] = discount.data[0]["value"]
-            await update.message.reply_text(f"Coupon accepted! You get ₹{discount.data[0]['value']} off.")
-            await update.message.reply_text("🛒 Select a coupon type:", reply_markup=get_coupon_type_keyboard())
-            return ConversationHandler.END
+    discount = await db.discounts.lookup(code)
+    if discount:
+        context.user_data["discount_code"] = code
+        context.user_data["discount_value"] = discount["value"]
+        await update.message.reply_text(f"Coupon accepted! You get ₹{discount['value']} off.")
     else:
-        await update.message.reply_text("Invalid or already used coupon code. Continuing without discount.")
+        db.discounts.record_failure(update.effective_user.id)
+        await update.message.reply_text("Invalid, expired or already used coupon code. Continuing without discount.")
     await update.message.reply_text("🛒 Select a coupon type:", reply_markup=get_coupon_type_keyboard())
     return ConversationHandler.END
 
 # --- Coupon type selection ---
+@timed
 async def coupon_type_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await check_bot_status(update, context):
         return
     query = update.callback_query
     await query.answer()
     ctype = query.data.split("_")[1]
+    if ctype not in COUPON_TYPES:
+        return
     context.user_data["coupon_type"] = ctype
 
-    count = supabase.table("coupons").select("*", count="exact").eq("type", ctype).eq("is_used", False).execute()
-    stock = count.count if hasattr(count, "count") else 0
-    min_qty = get_min_quantity(ctype)
-
-    await query.edit_message_text(
-        f"🏷️ {ctype} Off\n📦 Available stock: {stock}\n⚠️ Minimum quantity: {min_qty}\n\n📋 Available Packages (per-code):",
-        reply_markup=get_quantity_keyboard(ctype)
-    )
+    await query.edit_message_text(get_coupon_type_message(ctype), reply_markup=get_quantity_keyboard(ctype))
 
 # --- Quantity selection ---
+@timed
 async def quantity_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await check_bot_status(update, context):
         return
@@ -289,6 +615,7 @@ async def quantity_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await process_quantity(update, context, qty)
         return ConversationHandler.END
 
+@timed
 async def custom_quantity_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await check_bot_status(update, context):
         return ConversationHandler.END
@@ -306,20 +633,23 @@ async def custom_quantity_input(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text("Invalid number. Please use the menu again.")
     return ConversationHandler.END
 
+@timed
 async def process_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE, qty):
     ctype = context.user_data["coupon_type"]
+    # A new invoice replaces the user's previous unpaid one instead of stacking holds
+    previous_order_id = context.user_data.pop("order_id", None)
+    if previous_order_id:
+        await db.cancel_order(previous_order_id, update.effective_user.id)
     # Check stock
-    count = supabase.table("coupons").select("*", count="exact").eq("type", ctype).eq("is_used", False).execute()
-    stock = count.count if hasattr(count, "count") else 0
+    stock = db.stock.get(ctype)
     if stock < qty:
         await (update.message or update.callback_query.message).reply_text(f"❌ Only {stock} codes available for {ctype} Off.")
         return
 
-    prices = supabase.table("prices").select("*").eq("coupon_type", ctype).execute()
-    if not prices.data:
+    p = db.price_catalog.get(ctype)
+    if not p:
         await (update.message or update.callback_query.message).reply_text("Price error.")
         return
-    p = prices.data[0]
     # Price bracket logic (bulk discount)
     if qty <= 1:
         price_per = p["price_1"]
@@ -331,37 +661,68 @@ async def process_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE, q
         price_per = p["price_20"]
     total = price_per * qty
 
+    # Hold the codes for the lifetime of the invoice so paid orders don't find the stock gone
+    order_id = generate_order_id()
+    reserved = await db.reserve_coupons(order_id, update.effective_user.id, ctype, qty)
+    if reserved == "too_many_open":
+        await (update.message or update.callback_query.message).reply_text(
+            "❌ You already have orders waiting for payment or approval. Please wait until they are processed."
+        )
+        return
+    if reserved != "reserved":
+        await db.stock.reconcile()
+        await (update.message or update.callback_query.message).reply_text(
+            f"❌ Only {db.stock.get(ctype)} codes available for {ctype} Off."
+        )
+        return
+
     discount_code = context.user_data.get("discount_code")
     discount_value = context.user_data.get("discount_value", 0)
-    if discount_value:
-        total -= discount_value
-        if total < 0:
-            total = 0
+    discount_taken = False
+    # Anything failing from here on hands the codes (and the discount use) back
+    try:
+        if discount_code:
+            # Takes one use of the code now, so it cannot be attached to more orders than it allows
+            discount_value = await db.discounts.reserve(discount_code)
+            discount_taken = discount_value is not None
+            if not discount_taken:
+                await (update.message or update.callback_query.message).reply_text(
+                    f"⚠️ Coupon {discount_code} is no longer available. Continuing without discount."
+                )
+                discount_code = None
+                discount_value = 0
+        if discount_value:
+            total -= discount_value
+            if total < 0:
+                total = 0
+
+        # Insert order with discount_code (if any)
+        order_data = {
+            "order_id": order_id,
+            "user_id": update.effective_user.id,
+            "coupon_type": ctype,
+            "quantity": qty,
+            "total_price": total,
+            "status": "pending"
+        }
+        if discount_code:
+            order_data["discount_code"] = discount_code
+        await db.insert_order(order_data, update.effective_user.username)
+    except Exception:
+        await db.release_reservation(order_id, ctype)
+        if discount_taken:
+            await db.discounts.release(discount_code)
+        raise
 
-    order_id = generate_order_id()
     context.user_data["order_id"] = order_id
     context.user_data["qty"] = qty
     context.user_data["total"] = total
 
-    # Insert order with discount_code (if any)
-    order_data = {
-        "order_id": order_id,
-        "user_id": update.effective_user.id,
-        "coupon_type": ctype,
-        "quantity": qty,
-        "total_price": total,
-        "status": "pending"
-    }
-    if discount_code:
-        order_data["discount_code"] = discount_code
-    supabase.table("orders").insert(order_data).execute()
-
     # Remove discount from user_data after order creation
     context.user_data.pop("discount_code", None)
     context.user_data.pop("discount_value", None)
 
-    qr_setting = supabase.table("settings").select("value").eq("key", "qr_image").execute()
-    qr_file_id = qr_setting.data[0]["value"] if qr_setting.data and qr_setting.data[0]["value"] else None
+    qr_file_id = await db.get_setting("qr_image")
 
     invoice_text = (
         f"🧾 INVOICE\n━━━━━━━━━━━━━━\n"
@@ -385,6 +746,7 @@ async def process_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE, q
     await (update.message or update.callback_query.message).reply_text("After payment, click Verify.", reply_markup=verify_keyboard)
 
 # --- Payment verification ---
+@timed
 async def verify_payment_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await check_bot_status(update, context):
         return ConversationHandler.END
@@ -395,6 +757,7 @@ async def verify_payment_start(update: Update, context: ContextTypes.DEFAULT_TYP
     await query.edit_message_text("Please enter the payer name (the name used for payment):")
     return WAITING_PAYER_NAME
 
+@timed
 async def payment_name_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await check_bot_status(update, context):
         return ConversationHandler.END
@@ -402,6 +765,7 @@ async def payment_name_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     await update.message.reply_text("Please send the screenshot of the payment:")
     return WAITING_PAYMENT_SCREENSHOT
 
+@timed
 async def payment_screenshot_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await check_bot_status(update, context):
         return ConversationHandler.END
@@ -409,13 +773,21 @@ async def payment_screenshot_handler(update: Update, context: ContextTypes.DEFAU
     file_id = photo.file_id
     order_id = context.user_data["verify_order_id"]
 
-    order = supabase.table("orders").select("*").eq("order_id", order_id).execute()
-    if not order.data:
+    user = update.effective_user
+    o = await db.mark_order_verified(order_id, user.id)
+    held = None
+    if o:
+        # Hold the codes while the payment waits for an admin; only the first
+        # screenshot for an order does this
+        held = await db.extend_reservation(order_id)
+    else:
+        o = await db.get_order(order_id)
+    if not o or o["user_id"] != user.id:
         await update.message.reply_text("Order not found.")
         return ConversationHandler.END
-    o = order.data[0]
+    if context.user_data.get("order_id") == order_id:
+        context.user_data.pop("order_id")
 
-    user = update.effective_user
     user_mention = f"@{user.username}" if user.username else user.first_name
     payer_name = context.user_data["payer_name"]
 
@@ -426,8 +798,10 @@ async def payment_screenshot_handler(update: Update, context: ContextTypes.DEFAU
         f"Order: {o['order_id']}\n"
         f"Type: {o['coupon_type']} x{o['quantity']}\n"
         f"Total: ₹{o['total_price']}\n\n"
-        f"Accept or Decline?"
     )
+    if held is not None and held < o["quantity"]:
+        admin_msg += "⚠️ The reservation expired; accepting takes codes from available stock.\n\n"
+    admin_msg += "Accept or Decline?"
     accept_keyboard = InlineKeyboardMarkup([
         [InlineKeyboardButton("✅ Accept", callback_data=f"accept_{o['order_id']}"),
          InlineKeyboardButton("❌ Decline", callback_data=f"decline_{o['order_id']}")]
@@ -445,6 +819,7 @@ async def payment_screenshot_handler(update: Update, context: ContextTypes.DEFAU
     return ConversationHandler.END
 
 # --- Admin accept/decline ---
+@timed
 async def admin_accept_decline(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -452,44 +827,35 @@ async def admin_accept_decline(update: Update, context: ContextTypes.DEFAULT_TYP
     action = data[0]
     order_id = data[1]
 
-    order = supabase.table("orders").select("*").eq("order_id", order_id).execute()
-    if not order.data:
-        await query.edit_message_text("Order not found.")
-        return
-    o = order.data[0]
-
-    if o["status"] != "pending":
-        await query.edit_message_text(f"❌ Order {order_id} already processed (status: {o['status']}).")
-        return
-
     if action == "accept":
-        coupons = supabase.table("coupons").select("*").eq("type", o["coupon_type"]).eq("is_used", False).limit(o["quantity"]).execute()
-        if len(coupons.data) < o["quantity"]:
+        # Claims the codes and completes the order in one transaction
+        result = await db.allocate_order(order_id)
+        if result["status"] == "not_found":
+            await query.edit_message_text("Order not found.")
+            return
+        if result["status"] == "insufficient_stock":
             await query.edit_message_text("❌ Insufficient stock! Cannot accept payment.")
             return
+        if result["status"] != "completed":
+            await query.edit_message_text(f"❌ Order {order_id} already processed (status: {result['status']}).")
+            return
 
-        codes = [c["code"] for c in coupons.data]
-        for c in coupons.data:
-            supabase.table("coupons").update({
-                "is_used": True,
-                "used_by": o["user_id"],
-                "used_at": datetime.utcnow().isoformat()
-            }).eq("id", c["id"]).execute()
-
-        supabase.table("orders").update({"status": "completed"}).eq("order_id", order_id).execute()
-
-        # Mark discount code as used if present
-        if o.get("discount_code"):
-            supabase.table("discount_codes").update({"used": True}).eq("code", o["discount_code"]).execute()
-
+        codes = result["codes"]
         codes_text = "\n".join(codes)
         await context.bot.send_message(
-            o["user_id"],
+            result["user_id"],
             f"✅ Payment accepted! Here are your codes:\n{codes_text}\n\nThanks for purchasing!"
         )
         await query.edit_message_text(f"✅ Order {order_id} completed.")
     else:
-        supabase.table("orders").update({"status": "declined"}).eq("order_id", order_id).execute()
+        o = await db.decline_order(order_id)
+        if not o:
+            o = await db.get_order(order_id)
+            if not o:
+                await query.edit_message_text("Order not found.")
+            else:
+                await query.edit_message_text(f"❌ Order {order_id} already processed (status: {o['status']}).")
+            return
         await context.bot.send_message(
             o["user_id"],
             "❌ Your payment has been declined by admin. If there is any issue, contact support."
@@ -497,12 +863,14 @@ async def admin_accept_decline(update: Update, context: ContextTypes.DEFAULT_TYP
         await query.edit_message_text(f"❌ Order {order_id} declined.")
 
 # ==================== ADMIN PANEL ====================
+@timed
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS:
         await update.message.reply_text("Unauthorized.")
         return
-    await update.message.reply_text("Admin Panel", reply_markup=get_admin_panel_keyboard())
+    await update.message.reply_text("Admin Panel", reply_markup=await get_admin_panel_keyboard())
 
+@timed
 async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -522,11 +890,11 @@ async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif data == "admin_remove":
         await query.edit_message_text("Select coupon type to remove:", reply_markup=get_coupon_type_admin_keyboard("remove"))
     elif data == "admin_stock":
+        # Admins restock from this view, so refresh the counter from the database first
+        await db.stock.reconcile()
         msg = "Current Stock:\n"
         for ct in COUPON_TYPES:
-            count = supabase.table("coupons").select("*", count="exact").eq("type", ct).eq("is_used", False).execute()
-            stock = count.count if hasattr(count, "count") else 0
-            msg += f"{ct} Off: {stock}\n"
+            msg += f"{ct} Off: {db.stock.get(ct)}\n"
         await query.edit_message_text(msg)
     elif data == "admin_free":
         await query.edit_message_text("Select coupon type to get free codes:", reply_markup=get_coupon_type_admin_keyboard("free"))
@@ -536,29 +904,27 @@ async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("Select coupon type to set minimum quantity:", reply_markup=get_coupon_type_admin_keyboard("minqty"))
     elif data == "admin_gen_discount":
         context.user_data["admin_action"] = "gen_discount"
-        await query.edit_message_text("Enter the discount value in rupees (e.g., 50):")
+        await query.edit_message_text("Enter the discount value in rupees (e.g., 50). For a multi-use code add the number of uses (e.g., 50 10):")
     elif data == "admin_broadcast":
         context.user_data["broadcast"] = True
         await query.edit_message_text("Send the message you want to broadcast to all users:")
     elif data == "admin_last10":
-        orders = supabase.table("orders").select("*").order("created_at", desc=True).limit(10).execute()
-        if not orders.data:
+        orders = await db.recent_orders.get()
+        if not orders:
             await query.edit_message_text("No orders yet.")
         else:
             msg = "Last 10 purchases:\n"
-            for o in orders.data:
-                user = supabase.table("users").select("username").eq("user_id", o["user_id"]).execute()
-                username = user.data[0]["username"] if user.data else "Unknown"
+            for o in orders:
+                username = o["username"] or "Unknown"
                 msg += f"{o['order_id']}: {username} - {o['coupon_type']} x{o['quantity']} - {o['status']} - {o['created_at'][:19]}\n"
             await query.edit_message_text(msg)
     elif data == "admin_qr":
         context.user_data["awaiting_qr"] = True
         await query.edit_message_text("Send the new QR code image.")
     elif data == "admin_toggle":
-        status = supabase.table("settings").select("value").eq("key", "bot_status").execute()
-        current = status.data[0]["value"] if status.data else "on"
+        current = await db.get_setting("bot_status", "on")
         new_status = "off" if current == "on" else "on"
-        supabase.table("settings").upsert({"key": "bot_status", "value": new_status}).execute()
+        await db.set_setting("bot_status", new_status)
         await query.edit_message_text(f"Bot status changed to {new_status.upper()}.")
     elif data.startswith("admin_add_"):
         ctype = data.split("_")[2]
@@ -592,6 +958,7 @@ async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data["admin_action"] = ("minqty", ctype)
         await query.edit_message_text(f"Enter minimum quantity for {ctype} Off:")
 
+@timed
 async def admin_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS:
         return
@@ -606,33 +973,22 @@ async def admin_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
             context.user_data.pop("broadcast", None)
             return
 
-        # Fetch all users
-        users = supabase.table("users").select("user_id").execute()
-        if not users.data:
-            await update.message.reply_text("No users found in database.")
-            context.user_data.pop("broadcast", None)
-            return
-
-        total = len(users.data)
-        success = 0
-        failed = 0
-        for u in users.data:
-            try:
-                await context.bot.send_message(chat_id=u["user_id"], text=msg_text)
-                success += 1
-            except Exception as e:
-                failed += 1
-                logger.error(f"Broadcast failed for user {u['user_id']}: {e}")
-
-        await update.message.reply_text(f"📢 Broadcast sent.\n✅ Success: {success}\n❌ Failed: {failed}\n👥 Total users: {total}")
         context.user_data.pop("broadcast", None)
+        if broadcast.is_running():
+            await update.message.reply_text("⏳ Another broadcast is still running. Try again when it finishes.")
+            return
+        # Runs in the background; progress is posted as edits to a status message
+        if not await broadcast.start(context.application, msg_text, update.effective_chat.id):
+            await update.message.reply_text(
+                "⏳ An interrupted broadcast will resume on the next restart. Try again when it finishes."
+            )
         return
 
     # --- QR code update handling ---
     if context.user_data.get("awaiting_qr"):
         if photo:
             file_id = photo.file_id
-            supabase.table("settings").upsert({"key": "qr_image", "value": file_id}).execute()
+            await db.set_setting("qr_image", file_id)
             await update.message.reply_text("QR code updated.")
             context.user_data.pop("awaiting_qr", None)
         else:
@@ -646,27 +1002,47 @@ async def admin_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
 
     if admin_action[0] == "add":
         ctype = admin_action[1]
-        codes = text.strip().split("\n")
-        inserted = 0
-        for code in codes:
-            code = code.strip()
-            if code:
-                try:
-                    supabase.table("coupons").insert({"code": code, "type": ctype}).execute()
-                    inserted += 1
-                except:
-                    pass
-        await update.message.reply_text(f"{inserted} coupons added to {ctype} Off.")
+        codes = []
+        seen = set()
+        duplicates = 0
+        invalid = 0
+        for line in text.strip().split("\n"):
+            code = line.strip()
+            if not code:
+                continue
+            if len(code) > MAX_CODE_LENGTH or any(ch.isspace() for ch in code):
+                invalid += 1
+            elif code in seen:
+                duplicates += 1
+            else:
+                seen.add(code)
+                codes.append(code)
+        try:
+            inserted = await db.insert_coupons(codes, ctype)
+        except Exception as e:
+            logger.error(f"Bulk coupon insert failed for {ctype}: {e}")
+            await db.stock.reconcile()
+            await update.message.reply_text(f"❌ Adding coupons failed: {e}\nStock now: {db.stock.get(ctype)}")
+            context.user_data.pop("admin_action", None)
+            return
+        duplicates += len(codes) - inserted
+        db.stock.adjust(ctype, inserted)
+        await update.message.reply_text(
+            f"{inserted} coupons added to {ctype} Off.\n"
+            f"♻️ Duplicates skipped: {duplicates}\n"
+            f"⚠️ Invalid lines: {invalid}"
+        )
         context.user_data.pop("admin_action", None)
 
     elif admin_action[0] == "remove":
         ctype = admin_action[1]
         try:
             num = int(text)
-            coupons = supabase.table("coupons").select("id").eq("type", ctype).eq("is_used", False).order("id").limit(num).execute()
-            ids = [c["id"] for c in coupons.data]
+            coupons = await db.get_unused_coupons(ctype, num, columns="id")
+            ids = [c["id"] for c in coupons]
             if ids:
-                supabase.table("coupons").delete().in_("id", ids).execute()
+                await db.delete_coupons(ids)
+                db.stock.adjust(ctype, -len(ids))
             await update.message.reply_text(f"Removed {len(ids)} coupons from {ctype} Off.")
         except ValueError:
             await update.message.reply_text("Invalid number.")
@@ -676,17 +1052,15 @@ async def admin_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
         ctype = admin_action[1]
         try:
             num = int(text)
-            coupons = supabase.table("coupons").select("code").eq("type", ctype).eq("is_used", False).limit(num).execute()
-            if len(coupons.data) < num:
-                await update.message.reply_text(f"Only {len(coupons.data)} available.")
-            codes = [c["code"] for c in coupons.data]
-            for c in coupons.data:
-                supabase.table("coupons").update({
-                    "is_used": True,
-                    "used_by": update.effective_user.id,
-                    "used_at": datetime.utcnow().isoformat()
-                }).eq("code", c["code"]).execute()
-            await update.message.reply_text(f"Here are your free codes:\n" + "\n".join(codes))
+            if num <= 0:
+                raise ValueError
+            codes = await db.claim_coupons(ctype, num, update.effective_user.id)
+            if codes is None:
+                await db.stock.reconcile()
+                await update.message.reply_text(f"Only {db.stock.get(ctype)} available.")
+            else:
+                db.stock.adjust(ctype, -len(codes))
+                await update.message.reply_text(f"Here are your free codes:\n" + "\n".join(codes))
         except ValueError:
             await update.message.reply_text("Invalid number.")
         context.user_data.pop("admin_action", None)
@@ -697,7 +1071,7 @@ async def admin_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
         try:
             new_price = float(text)
             col = f"price_{qty}"
-            supabase.table("prices").update({col: new_price}).eq("coupon_type", ctype).execute()
+            await db.price_catalog.update(ctype, {col: new_price})
             await update.message.reply_text(f"Price updated for {ctype} Off, {qty} Qty: ₹{new_price}")
         except ValueError:
             await update.message.reply_text("Invalid number.")
@@ -709,7 +1083,7 @@ async def admin_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
             min_qty = int(text)
             if min_qty < 1:
                 raise ValueError
-            supabase.table("prices").update({"min_quantity": min_qty}).eq("coupon_type", ctype).execute()
+            await db.price_catalog.update(ctype, {"min_quantity": min_qty})
             await update.message.reply_text(f"Minimum quantity for {ctype} Off set to {min_qty}.")
         except ValueError:
             await update.message.reply_text("Invalid number (must be >=1).")
@@ -717,14 +1091,14 @@ async def admin_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
 
     elif admin_action == "gen_discount":
         try:
-            value = float(text)
+            parts = text.split()
+            value = float(parts[0])
+            max_uses = int(parts[1]) if len(parts) > 1 else 1
+            if max_uses < 1:
+                raise ValueError
             code = generate_discount_code()
-            supabase.table("discount_codes").insert({
-                "code": code,
-                "value": value,
-                "created_by": update.effective_user.id
-            }).execute()
-            await update.message.reply_text(f"✅ Discount code generated: `{code}` with value ₹{value}")
+            await db.discounts.create(code, value, update.effective_user.id, max_uses)
+            await update.message.reply_text(f"✅ Discount code generated: `{code}` with value ₹{value} ({max_uses} use(s))")
         except ValueError:
             await update.message.reply_text("Invalid number.")
         context.user_data.pop("admin_action", None)
@@ -734,7 +1108,9 @@ custom_qty_conv = ConversationHandler(
     states={
         CUSTOM_QUANTITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, custom_quantity_input)]
     },
-    fallbacks=[]
+    fallbacks=[],
+    name="custom_qty_conv",
+    persistent=True
 )
 
 payment_conv = ConversationHandler(
@@ -743,7 +1119,9 @@ payment_conv = ConversationHandler(
         WAITING_PAYER_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, payment_name_handler)],
         WAITING_PAYMENT_SCREENSHOT: [MessageHandler(filters.PHOTO, payment_screenshot_handler)]
     },
-    fallbacks=[]
+    fallbacks=[],
+    name="payment_conv",
+    persistent=True
 )
 
 coupon_conv = ConversationHandler(
@@ -751,11 +1129,54 @@ coupon_conv = ConversationHandler(
     states={
         ENTER_COUPON: [MessageHandler(filters.TEXT & ~filters.COMMAND, enter_coupon_handler)]
     },
-    fallbacks=[]
+    fallbacks=[],
+    name="coupon_conv",
+    persistent=True
 )
 
 # ==================== APPLICATION SETUP ====================
-application = Application.builder().token(TELEGRAM_TOKEN).build()
+async def reconcile_stock(context: ContextTypes.DEFAULT_TYPE):
+    await db.stock.reconcile()
+
+async def flush_users(context: ContextTypes.DEFAULT_TYPE):
+    await db.users.flush()
+
+async def sweep_reservations(context: ContextTypes.DEFAULT_TYPE):
+    released = await db.sweep_reservations()
+    if released:
+        logger.info(f"Released {released} expired coupon reservations")
+
+async def expire_orders(context: ContextTypes.DEFAULT_TYPE):
+    expired = await db.expire_pending_orders()
+    logger.info(f"Expired {expired} stale pending orders")
+
+async def post_init(application: Application):
+    await db.price_catalog.load()
+    await db.stock.reconcile()
+    application.job_queue.run_repeating(
+        reconcile_stock, interval=db.STOCK_RECONCILE_INTERVAL, first=db.STOCK_RECONCILE_INTERVAL
+    )
+    application.job_queue.run_repeating(flush_users, interval=db.USER_FLUSH_INTERVAL)
+    application.job_queue.run_repeating(sweep_reservations, interval=db.RESERVATION_SWEEP_INTERVAL)
+    application.job_queue.run_repeating(expire_orders, interval=db.ORDER_SWEEP_INTERVAL)
+    await broadcast.resume(application)
+
+async def post_stop(application: Application):
+    await broadcast.stop()
+
+async def post_shutdown(application: Application):
+    await db.users.flush()
+    db.shutdown()
+
+application = (
+    Application.builder()
+    .token(TELEGRAM_TOKEN)
+    .base_url(TELEGRAM_API_URL)
+    .request(TimedRequest(connection_pool_size=256))
+    .persistence(create_persistence())
+    .concurrent_updates(PerChatUpdateProcessor())
+    .build()
+)
 
 # Command handlers
 application.add_handler(CommandHandler("start", start))
@@ -775,6 +1196,7 @@ application.add_handler(CallbackQueryHandler(admin_accept_decline, pattern="^(ac
 application.add_handler(CallbackQueryHandler(admin_callback, pattern="^admin_"))
 
 # Photo handler for QR update
+@timed
 async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if user.id in ADMIN_IDS and context.user_data.get("awaiting_qr"):
@@ -784,29 +1206,32 @@ application.add_handler(MessageHandler(filters.PHOTO, photo_handler))
 # General text handler (must be last)
 application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, menu_handler))
 
-# ==================== FLASK WEBHOOK ====================
-app = Flask(__name__)
-
-@app.route("/webhook", methods=["POST"])
-def webhook():
-    update = Update.de_json(request.get_json(force=True), application.bot)
-    application.update_queue.put_nowait(update)
-    return "ok", 200
+# ==================== WEBHOOK SERVER ====================
+# One process, one event loop: the tornado server that PTB already depends on
+# serves the webhook next to the health and admin endpoints, and pushes
+# updates straight into the application's queue.
+async def main():
+    await application.initialize()
+    await post_init(application)
+    await application.bot.set_webhook(
+        url=f"{WEBHOOK_URL}/{TELEGRAM_TOKEN}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=Update.ALL_TYPES
+    )
+    await application.start()
+    server = start_server(application, PORT, f"/{TELEGRAM_TOKEN}")
 
-@app.route("/set_webhook", methods=["GET"])
-def set_webhook():
-    url = WEBHOOK_URL + "/webhook"
-    application.bot.set_webhook(url=url)
-    return f"Webhook set to {url}", 200
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
 
-@app.route("/")
-def home():
-    return "Bot is running!", 200
+    server.stop()
+    await post_stop(application)
+    await application.stop()
+    await application.shutdown()
+    await post_shutdown(application)
 
 if __name__ == "__main__":
-    application.run_webhook(
-        listen="0.0.0.0",
-        port=int(os.environ.get("PORT", 5000)),
-        url_path=TELEGRAM_TOKEN,
-        webhook_url=f"{WEBHOOK_URL}/{TELEGRAM_TOKEN}"
-    )
+    asyncio.run(main())
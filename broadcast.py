@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from telegram.error import RetryAfter, Forbidden, BadRequest
+import db
+
+# ==================== CONFIG ====================
+BROADCAST_PAGE_SIZE = int(os.environ.get("BROADCAST_PAGE_SIZE", 500))
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", 20))
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", 25))  # messages per second, all workers combined
+BROADCAST_PROGRESS_INTERVAL = float(os.environ.get("BROADCAST_PROGRESS_INTERVAL", 10))
+CHECKPOINT_KEY = "broadcast_job"
+
+logger = logging.getLogger(__name__)
+
+# ==================== RATE LIMITER ====================
+# Hands out send slots spaced 1/rate apart. A RetryAfter from Telegram pushes
+# the next slot out for every worker, not just the one that was throttled.
+class RateLimiter:
+    def __init__(self, rate):
+        self._interval = 1 / rate
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self._interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def pause(self, seconds):
+        self._next_slot = max(self._next_slot, time.monotonic() + seconds)
+
+# ==================== JOB ====================
+# Only one broadcast runs at a time. Its progress is checkpointed to the
+# settings table after every page of users, so a restart resumes from the
+# last finished page (users on the interrupted page may get the message twice).
+# A checkpoint left by a failed run blocks new broadcasts until it resumes.
+_task = None
+_starting = False
+
+def is_running():
+    return _starting or (_task is not None and not _task.done())
+
+async def start(application, text, admin_chat_id):
+    # Returns False if another broadcast is running or waiting to resume
+    global _starting
+    if is_running():
+        return False
+    # Claimed before the first await so a second admin cannot start one too
+    _starting = True
+    try:
+        if await db.get_setting(CHECKPOINT_KEY):
+            return False
+        status = await application.bot.send_message(admin_chat_id, "📢 Broadcast started…")
+        job = {
+            "text": text,
+            "admin_chat_id": admin_chat_id,
+            "status_message_id": status.message_id,
+            "last_user_id": None,
+            "total": await db.count_users(),
+            "success": 0,
+            "failed": 0
+        }
+        await _save(job)
+        _spawn(application, job)
+        return True
+    finally:
+        _starting = False
+
+async def resume(application):
+    raw = await db.get_setting(CHECKPOINT_KEY)
+    if raw:
+        job = json.loads(raw)
+        logger.info(f"Resuming broadcast after user {job['last_user_id']}")
+        _spawn(application, job)
+
+async def stop():
+    if is_running():
+        _task.cancel()
+
+def _spawn(application, job):
+    # Not application.create_task: the application waits for those on stop,
+    # and a broadcast can take much longer than a deploy should.
+    global _task
+    _task = asyncio.get_running_loop().create_task(_run(application, job))
+
+async def _save(job):
+    await db.set_setting(CHECKPOINT_KEY, json.dumps(job))
+
+async def _run(application, job):
+    bot = application.bot
+    limiter = RateLimiter(BROADCAST_RATE)
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    last_progress = time.monotonic()
+
+    async def send(user_id):
+        async with semaphore:
+            while True:
+                await limiter.acquire()
+                try:
+                    await bot.send_message(chat_id=user_id, text=job["text"])
+                    return True
+                except RetryAfter as e:
+                    limiter.pause(e.retry_after)
+                except Exception as e:
+                    if not isinstance(e, (Forbidden, BadRequest)):
+                        logger.error(f"Broadcast failed for user {user_id}: {e}")
+                    return False
+
+    try:
+        while True:
+            user_ids = await db.get_user_ids_page(job["last_user_id"], BROADCAST_PAGE_SIZE)
+            if not user_ids:
+                break
+            results = await asyncio.gather(*(send(uid) for uid in user_ids))
+            job["success"] += sum(results)
+            job["failed"] += len(results) - sum(results)
+            job["last_user_id"] = user_ids[-1]
+            await _save(job)
+            if time.monotonic() - last_progress >= BROADCAST_PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                await _report(bot, job, "📢 Broadcast in progress…")
+        await db.delete_setting(CHECKPOINT_KEY)
+        await _report(bot, job, "📢 Broadcast sent.")
+    except asyncio.CancelledError:
+        # Shutdown: the checkpoint stays in place and the job resumes on next start
+        raise
+    except Exception as e:
+        logger.error(f"Broadcast stopped: {e}")
+        await _report(bot, job, f"⚠️ Broadcast interrupted: {e}\nIt will resume on the next restart.")
+
+async def _report(bot, job, title):
+    text = (
+        f"{title}\n✅ Success: {job['success']}\n❌ Failed: {job['failed']}\n"
+        f"👥 Total users: {job['total']}"
+    )
+    try:
+        await bot.edit_message_text(text, chat_id=job["admin_chat_id"], message_id=job["status_message_id"])
+    except Exception as e:
+        logger.warning(f"Could not update broadcast progress: {e}")
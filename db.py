@@ -0,0 +1,519 @@
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime, timezone, timedelta
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from supabase import create_client, Client
+import metrics
+
+# ==================== CONFIG ====================
+SUPABASE_URL = os.environ.get("SUPABASE_URL")
+SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 16))
+SETTINGS_TTL = float(os.environ.get("SETTINGS_TTL", 30))
+STOCK_RECONCILE_INTERVAL = float(os.environ.get("STOCK_RECONCILE_INTERVAL", 60))
+COUPON_INSERT_CHUNK = int(os.environ.get("COUPON_INSERT_CHUNK", 1000))
+RECENT_ORDERS_SIZE = int(os.environ.get("RECENT_ORDERS_SIZE", 10))
+RECENT_ORDERS_TTL = float(os.environ.get("RECENT_ORDERS_TTL", 300))
+USER_FLUSH_INTERVAL = float(os.environ.get("USER_FLUSH_INTERVAL", 5))
+RESERVATION_TTL = int(os.environ.get("RESERVATION_TTL", 600))  # matches "QR valid for 10 minutes"
+REVIEW_RESERVATION_TTL = int(os.environ.get("REVIEW_RESERVATION_TTL", 86400))  # once the payment screenshot is in
+MAX_OPEN_ORDERS = int(os.environ.get("MAX_OPEN_ORDERS", 3))  # orders per user holding codes at once
+RESERVATION_SWEEP_INTERVAL = float(os.environ.get("RESERVATION_SWEEP_INTERVAL", 60))
+RESERVATION_SWEEP_BATCH = int(os.environ.get("RESERVATION_SWEEP_BATCH", 500))
+ORDER_EXPIRY = int(os.environ.get("ORDER_EXPIRY", 86400))
+ORDER_SWEEP_INTERVAL = float(os.environ.get("ORDER_SWEEP_INTERVAL", 300))
+ORDER_SWEEP_BATCH = int(os.environ.get("ORDER_SWEEP_BATCH", 500))
+DISCOUNT_CACHE_TTL = float(os.environ.get("DISCOUNT_CACHE_TTL", 60))
+DISCOUNT_NEGATIVE_TTL = float(os.environ.get("DISCOUNT_NEGATIVE_TTL", 600))
+DISCOUNT_NEGATIVE_SIZE = int(os.environ.get("DISCOUNT_NEGATIVE_SIZE", 10000))
+DISCOUNT_MAX_FAILURES = int(os.environ.get("DISCOUNT_MAX_FAILURES", 5))
+DISCOUNT_FAILURE_WINDOW = float(os.environ.get("DISCOUNT_FAILURE_WINDOW", 600))
+
+supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+
+logger = logging.getLogger(__name__)
+
+# The supabase client is synchronous, so every round-trip runs on a bounded
+# thread pool. Handlers await these coroutines and the event loop keeps serving
+# other updates while a request is in flight.
+_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+
+async def execute(query):
+    loop = asyncio.get_running_loop()
+    table, op = metrics.describe_query(query)
+    start = time.perf_counter()
+    try:
+        return await loop.run_in_executor(_executor, query.execute)
+    except Exception:
+        metrics.db_errors.inc(table, op)
+        raise
+    finally:
+        metrics.db_seconds.observe(time.perf_counter() - start, table, op)
+
+def use_client(client):
+    # Swaps the client every query is built from, e.g. for fakes.FakeSupabase
+    global supabase
+    supabase = client
+
+def shutdown():
+    _executor.shutdown(wait=False)
+
+# ==================== SETTINGS ====================
+# bot_status is checked on every non-admin update and qr_image on every order,
+# so values are cached for SETTINGS_TTL seconds. Writes through this module
+# replace the cached value immediately; the TTL only bounds how long another
+# instance's change can go unnoticed.
+_settings_cache = {}
+
+async def get_setting(key, default=None):
+    cached = _settings_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        value = cached[1]
+    else:
+        result = await execute(supabase.table("settings").select("value").eq("key", key))
+        value = result.data[0]["value"] if result.data else None
+        _settings_cache[key] = (time.monotonic() + SETTINGS_TTL, value)
+    return value if value is not None else default
+
+async def set_setting(key, value):
+    _settings_cache.pop(key, None)
+    await execute(supabase.table("settings").upsert({"key": key, "value": value}))
+    _settings_cache[key] = (time.monotonic() + SETTINGS_TTL, value)
+
+def invalidate_settings():
+    _settings_cache.clear()
+
+async def delete_setting(key):
+    _settings_cache.pop(key, None)
+    await execute(supabase.table("settings").delete().eq("key", key))
+
+# ==================== PRICES ====================
+# The prices table is tiny and only changes through the admin panel, so it is
+# loaded once and served from memory. version is bumped on every change so
+# anything derived from prices can tell when it is out of date.
+class PriceCatalog:
+    def __init__(self):
+        self.version = 0
+        self._rows = {}
+
+    async def load(self):
+        result = await execute(supabase.table("prices").select("*"))
+        self._rows = {row["coupon_type"]: row for row in result.data}
+        self.version += 1
+
+    def get(self, coupon_type):
+        return self._rows.get(coupon_type)
+
+    async def update(self, coupon_type, fields):
+        result = await execute(supabase.table("prices").update(fields).eq("coupon_type", coupon_type))
+        if result.data:
+            self._rows[coupon_type] = result.data[0]
+            self.version += 1
+
+price_catalog = PriceCatalog()
+
+# ==================== COUPONS ====================
+async def stock_summary():
+    result = await execute(supabase.rpc("stock_summary", {}))
+    return {row["coupon_type"]: row for row in result.data}
+
+# Available stock per coupon type, kept in memory and adjusted by every code
+# path that adds, removes or hands out coupons. reconcile() resets it from the
+# database; it runs at startup and every STOCK_RECONCILE_INTERVAL seconds to
+# pick up changes made by other instances or directly in Supabase.
+class StockCounter:
+    def __init__(self):
+        self.version = 0
+        self._counts = {}
+
+    async def reconcile(self):
+        summary = await stock_summary()
+        counts = {ct: row["available"] for ct, row in summary.items()}
+        if counts != self._counts:
+            self._counts = counts
+            self.version += 1
+
+    def get(self, coupon_type):
+        return self._counts.get(coupon_type, 0)
+
+    def adjust(self, coupon_type, delta):
+        if delta:
+            self._counts[coupon_type] = max(0, self.get(coupon_type) + delta)
+            self.version += 1
+
+stock = StockCounter()
+
+async def get_unused_coupons(coupon_type, limit, columns="*"):
+    # Skips codes held by a live reservation
+    now = datetime.now(timezone.utc).isoformat()
+    result = await execute(
+        supabase.table("coupons").select(columns).eq("type", coupon_type).eq("is_used", False)
+        .or_(f"reserved_until.is.null,reserved_until.lt.{now}").order("id").limit(limit)
+    )
+    return result.data
+
+# Codes are soft-reserved for an order when its invoice is sent, so stock that
+# has been promised to a paying user is not sold twice, and the hold is
+# extended once the buyer submits proof of payment. A user can have at most
+# MAX_OPEN_ORDERS orders holding codes at a time. Like stock_summary(), the
+# stock counter treats a code as available once its reservation has expired,
+# whether or not the reservation has been cleared yet. Only releasing a live
+# reservation is adjusted for directly; anything that clears expired ones
+# reconciles the counter instead, since it may already include them.
+async def reserve_coupons(order_id, user_id, coupon_type, quantity):
+    # Returns "reserved", "insufficient_stock" or "too_many_open"
+    result = await execute(supabase.rpc("reserve_coupons", {
+        "p_order_id": order_id,
+        "p_user_id": user_id,
+        "p_type": coupon_type,
+        "p_quantity": quantity,
+        "p_ttl_seconds": RESERVATION_TTL,
+        "p_max_open": MAX_OPEN_ORDERS
+    }))
+    if result.data == "reserved":
+        stock.adjust(coupon_type, -quantity)
+    return result.data
+
+async def release_reservation(order_id, coupon_type):
+    # Expired holds already count as available and are left to the sweep
+    now = datetime.now(timezone.utc).isoformat()
+    result = await execute(
+        supabase.table("coupons").update({"reserved_for": None, "reserved_until": None})
+        .eq("reserved_for", order_id).eq("is_used", False).gt("reserved_until", now)
+    )
+    stock.adjust(coupon_type, len(result.data))
+
+async def extend_reservation(order_id):
+    # Returns how many codes are still held; a lapsed hold is not revived,
+    # since the stock counter already counts those codes as available
+    now = datetime.now(timezone.utc)
+    until = (now + timedelta(seconds=REVIEW_RESERVATION_TTL)).isoformat()
+    result = await execute(
+        supabase.table("coupons").update({"reserved_until": until})
+        .eq("reserved_for", order_id).eq("is_used", False).gt("reserved_until", now.isoformat())
+    )
+    return len(result.data)
+
+async def sweep_reservations():
+    total = 0
+    while True:
+        result = await execute(supabase.rpc("release_expired_reservations", {"p_limit": RESERVATION_SWEEP_BATCH}))
+        released = sum((result.data or {}).values())
+        total += released
+        if released < RESERVATION_SWEEP_BATCH:
+            break
+    if total:
+        await stock.reconcile()
+    return total
+
+async def claim_coupons(coupon_type, quantity, user_id):
+    # Returns the claimed codes, or None if fewer than quantity were available
+    result = await execute(supabase.rpc("claim_coupons", {
+        "p_type": coupon_type,
+        "p_quantity": quantity,
+        "p_user_id": user_id
+    }))
+    return result.data
+
+async def insert_coupons(codes, coupon_type):
+    # Codes already in the table are skipped by the unique index and not returned
+    inserted = 0
+    for i in range(0, len(codes), COUPON_INSERT_CHUNK):
+        rows = [{"code": code, "type": coupon_type} for code in codes[i:i + COUPON_INSERT_CHUNK]]
+        result = await execute(supabase.table("coupons").upsert(rows, on_conflict="code", ignore_duplicates=True))
+        inserted += len(result.data)
+    return inserted
+
+async def delete_coupons(ids):
+    await execute(supabase.table("coupons").delete().in_("id", ids))
+
+# ==================== USERS ====================
+# /start records the user without waiting on the database. Users whose
+# username and first_name match what was last written are skipped; the rest
+# are upserted in one batch by flush(), which runs every USER_FLUSH_INTERVAL
+# seconds. An order needs its buyer's row first, so ensure() writes that one
+# row on the spot. It only waits when a flush has already taken the buyer
+# off the queue and not finished writing.
+class UserWriter:
+    def __init__(self):
+        self._written = {}
+        self._pending = {}
+        self._in_flight = {}
+        self._lock = asyncio.Lock()
+
+    def note(self, user_id, username, first_name):
+        fingerprint = (username, first_name)
+        if self._written.get(user_id) == fingerprint:
+            self._pending.pop(user_id, None)
+        else:
+            self._pending[user_id] = fingerprint
+
+    async def flush(self):
+        async with self._lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            done = asyncio.Event()
+            for user_id in batch:
+                self._in_flight[user_id] = done
+            rows = [
+                {"user_id": user_id, "username": username, "first_name": first_name}
+                for user_id, (username, first_name) in batch.items()
+            ]
+            try:
+                await execute(supabase.table("users").upsert(rows))
+                self._written.update(batch)
+            except Exception as e:
+                logger.error(f"Upserting users failed: {e}")
+                for user_id, fingerprint in batch.items():
+                    self._pending.setdefault(user_id, fingerprint)
+            finally:
+                for user_id in batch:
+                    if self._in_flight.get(user_id) is done:
+                        del self._in_flight[user_id]
+                done.set()
+
+    async def ensure(self, user_id):
+        # Raises if the row could not be written
+        flushing = self._in_flight.get(user_id)
+        if flushing is not None:
+            await flushing.wait()
+        fingerprint = self._pending.pop(user_id, None)
+        if fingerprint is not None:
+            username, first_name = fingerprint
+            try:
+                await execute(supabase.table("users").upsert(
+                    {"user_id": user_id, "username": username, "first_name": first_name}
+                ))
+            except Exception:
+                self._pending.setdefault(user_id, fingerprint)
+                raise
+            self._written[user_id] = fingerprint
+        elif user_id not in self._written:
+            # Not seen by this process (e.g. since a restart): create the row
+            # if missing without touching the stored names
+            await execute(
+                supabase.table("users").upsert({"user_id": user_id}, on_conflict="user_id", ignore_duplicates=True)
+            )
+            self._written.setdefault(user_id, None)
+
+users = UserWriter()
+
+async def count_users():
+    result = await execute(supabase.table("users").select("user_id", count="exact", head=True))
+    return result.count or 0
+
+async def get_user_ids_page(after_user_id, limit):
+    # Keyset pagination: stable and index-backed no matter how deep the page is
+    query = supabase.table("users").select("user_id").order("user_id").limit(limit)
+    if after_user_id is not None:
+        query = query.gt("user_id", after_user_id)
+    result = await execute(query)
+    return [u["user_id"] for u in result.data]
+
+# ==================== ORDERS ====================
+# Ring buffer of the newest orders with usernames already resolved, fed by the
+# order functions below. A cold or expired buffer is refilled with one query
+# that embeds the username through the orders.user_id foreign key; the TTL
+# picks up orders created by other instances.
+class RecentOrders:
+    def __init__(self, size):
+        self._orders = deque(maxlen=size)
+        self._expires = 0
+
+    async def get(self):
+        if self._expires <= time.monotonic():
+            result = await execute(
+                supabase.table("orders").select("*, users(username)")
+                .order("created_at", desc=True).limit(self._orders.maxlen)
+            )
+            self._orders.clear()
+            for row in result.data:
+                user = row.pop("users", None) or {}
+                self._orders.append(dict(row, username=user.get("username")))
+            self._expires = time.monotonic() + RECENT_ORDERS_TTL
+        return list(self._orders)
+
+    def add(self, order, username):
+        self._orders.appendleft(dict(order, username=username))
+
+    def set_status(self, order_id, status):
+        for o in self._orders:
+            if o["order_id"] == order_id:
+                o["status"] = status
+
+recent_orders = RecentOrders(RECENT_ORDERS_SIZE)
+
+async def insert_order(order_data, username=None):
+    # orders.user_id references users, so the buyer's row has to exist first
+    await users.ensure(order_data["user_id"])
+    result = await execute(supabase.table("orders").insert(order_data))
+    recent_orders.add(result.data[0] if result.data else order_data, username)
+
+async def get_order(order_id):
+    result = await execute(supabase.table("orders").select("*").eq("order_id", order_id))
+    return result.data[0] if result.data else None
+
+async def mark_order_verified(order_id, user_id):
+    # Records the buyer's first payment screenshot, which keeps the order out
+    # of expire_pending_orders(); returns None if the order is not theirs, not
+    # pending or already verified
+    result = await execute(
+        supabase.table("orders").update({"verified_at": datetime.now(timezone.utc).isoformat()})
+        .eq("order_id", order_id).eq("user_id", user_id).eq("status", "pending").is_("verified_at", "null")
+    )
+    return result.data[0] if result.data else None
+
+async def allocate_order(order_id):
+    result = await execute(supabase.rpc("allocate_order", {"p_order_id": order_id}))
+    if result.data["status"] == "completed":
+        recent_orders.set_status(order_id, "completed")
+        if not result.data["from_reservation"]:
+            # The reservation had lapsed and was replaced by codes from available stock
+            await stock.reconcile()
+    return result.data
+
+async def decline_order(order_id):
+    # Only a pending order can be declined; returns None if it was not pending
+    result = await execute(
+        supabase.table("orders").update({"status": "declined"}).eq("order_id", order_id).eq("status", "pending")
+    )
+    if not result.data:
+        return None
+    order = result.data[0]
+    recent_orders.set_status(order_id, "declined")
+    await _release_order(order)
+    return order
+
+async def cancel_order(order_id, user_id):
+    # A buyer's unpaid order replaced by a new one; returns None if it was not
+    # theirs, is no longer pending or already has a payment screenshot
+    result = await execute(
+        supabase.table("orders").update({"status": "cancelled"})
+        .eq("order_id", order_id).eq("user_id", user_id).eq("status", "pending").is_("verified_at", "null")
+    )
+    if not result.data:
+        return None
+    order = result.data[0]
+    recent_orders.set_status(order_id, "cancelled")
+    await _release_order(order)
+    return order
+
+async def _release_order(order):
+    # Hands back what a pending order held: its codes and its discount use
+    await release_reservation(order["order_id"], order["coupon_type"])
+    if order.get("discount_code"):
+        await discounts.release(order["discount_code"])
+
+async def expire_pending_orders():
+    # Orders still pending after ORDER_EXPIRY seconds with no payment screenshot
+    # were abandoned; expiring them also returns their reserved codes and discount uses
+    total = 0
+    released = 0
+    while True:
+        result = await execute(supabase.rpc("expire_pending_orders", {
+            "p_max_age_seconds": ORDER_EXPIRY,
+            "p_limit": ORDER_SWEEP_BATCH
+        }))
+        for order_id in result.data["orders"]:
+            recent_orders.set_status(order_id, "expired")
+        released += sum(result.data["released"].values())
+        for code in result.data["discount_codes"]:
+            discounts.invalidate(code)
+        total += len(result.data["orders"])
+        if len(result.data["orders"]) < ORDER_SWEEP_BATCH:
+            break
+    if released:
+        await stock.reconcile()
+    return total
+
+async def get_user_orders(user_id, limit=10):
+    result = await execute(
+        supabase.table("orders").select("*").eq("user_id", user_id).order("created_at", desc=True).limit(limit)
+    )
+    return result.data
+
+# ==================== DISCOUNT CODES ====================
+# Lookups are cached: codes that exist for DISCOUNT_CACHE_TTL seconds and
+# unknown, used-up or expired codes for DISCOUNT_NEGATIVE_TTL, so repeated guesses
+# never reach the database. A user with DISCOUNT_MAX_FAILURES misses inside
+# DISCOUNT_FAILURE_WINDOW is throttled.
+#
+# A cached hit only means the code looked usable. The use itself is taken
+# atomically by reserve() when the order is created and given back by
+# release() when the order is declined or expires; codes with max_uses > 1
+# can be reserved that many times.
+def _discount_expired(row):
+    # expires_at comes back from PostgREST as an offset-aware ISO string
+    if not row.get("expires_at"):
+        return False
+    expires = datetime.fromisoformat(row["expires_at"])
+    if expires.tzinfo is None:
+        expires = expires.replace(tzinfo=timezone.utc)
+    return expires <= datetime.now(timezone.utc)
+
+class DiscountService:
+    def __init__(self):
+        self._known = {}
+        self._unknown = OrderedDict()
+        self._failures = {}
+
+    def is_throttled(self, user_id):
+        now = time.monotonic()
+        attempts = [t for t in self._failures.get(user_id, ()) if t > now - DISCOUNT_FAILURE_WINDOW]
+        if attempts:
+            self._failures[user_id] = attempts
+        else:
+            self._failures.pop(user_id, None)
+        return len(attempts) >= DISCOUNT_MAX_FAILURES
+
+    def record_failure(self, user_id):
+        self._failures.setdefault(user_id, []).append(time.monotonic())
+
+    async def lookup(self, code):
+        now = time.monotonic()
+        if self._unknown.get(code, 0) > now:
+            return None
+        cached = self._known.get(code)
+        if cached and cached[0] > now and not _discount_expired(cached[1]):
+            return cached[1]
+
+        result = await execute(supabase.table("discount_codes").select("*").eq("code", code))
+        row = result.data[0] if result.data else None
+        if row and row.get("uses", 0) < row.get("max_uses", 1) and not _discount_expired(row):
+            self._known[code] = (now + DISCOUNT_CACHE_TTL, row)
+            return row
+        self._known.pop(code, None)
+        self._unknown[code] = now + DISCOUNT_NEGATIVE_TTL
+        self._unknown.move_to_end(code)
+        if len(self._unknown) > DISCOUNT_NEGATIVE_SIZE:
+            self._unknown.popitem(last=False)
+        return None
+
+    async def reserve(self, code):
+        # Returns the discount value, or None if the code can no longer be used
+        self._known.pop(code, None)
+        result = await execute(supabase.rpc("reserve_discount", {"p_code": code}))
+        return result.data
+
+    def invalidate(self, code):
+        self._known.pop(code, None)
+        self._unknown.pop(code, None)
+
+    async def release(self, code):
+        self.invalidate(code)
+        await execute(supabase.rpc("release_discount", {"p_code": code}))
+
+    async def create(self, code, value, created_by, max_uses=1):
+        await execute(supabase.table("discount_codes").insert({
+            "code": code,
+            "value": value,
+            "created_by": created_by,
+            "max_uses": max_uses
+        }))
+        self._unknown.pop(code, None)
+
+discounts = DiscountService()
@@ -0,0 +1,475 @@
+import json
+import time
+import random
+import asyncio
+import threading
+from collections import Counter, defaultdict
+from datetime import datetime, timezone, timedelta
+import tornado.web
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from postgrest.exceptions import APIError
+
+# ==================== FAKE SUPABASE ====================
+# In-memory stand-in for the part of the supabase client the bot uses: table
+# queries with the filters below, plus the SQL functions from the schema in
+# bot.py reimplemented in Python. Install it with db.use_client(). Every
+# execute() sleeps for latency (+ up to jitter) seconds on the calling thread,
+# like a network round-trip would, and is counted in calls by (table, op).
+PRIMARY_KEYS = {
+    "users": ("user_id",),
+    "settings": ("key",),
+    "prices": ("coupon_type",),
+    "orders": ("order_id",),
+    "coupons": ("id",),
+    "discount_codes": ("code",),
+    "bot_persistence": ("kind", "key"),
+}
+FOREIGN_KEYS = {"orders": {"users": "user_id"}}
+DEFAULTS = {
+    "users": {"username": None, "first_name": None},
+    "orders": {"status": "pending", "discount_code": None, "verified_at": None},
+    "coupons": {"is_used": False, "used_by": None, "used_at": None, "reserved_for": None, "reserved_until": None},
+    "discount_codes": {"uses": 0, "max_uses": 1, "used": False, "expires_at": None},
+}
+TIMESTAMPED = {"users", "orders", "coupons", "discount_codes"}
+
+def _now(offset=0):
+    return (datetime.now(timezone.utc) + timedelta(seconds=offset)).isoformat(timespec="microseconds")
+
+def _split_columns(columns):
+    parts, depth, current = [], 0, ""
+    for ch in columns:
+        if ch == "," and depth == 0:
+            parts.append(current.strip())
+            current = ""
+            continue
+        depth += {"(": 1, ")": -1}.get(ch, 0)
+        current += ch
+    parts.append(current.strip())
+    return parts
+
+def _compare(op, left, right):
+    if op == "is":
+        return left is None if right in (None, "null") else left == right
+    if left is None:
+        return False
+    return {
+        "eq": left == right, "neq": left != right,
+        "gt": left > right, "gte": left >= right,
+        "lt": left < right, "lte": left <= right,
+    }[op]
+
+class FakeResponse:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+class FakeQuery:
+    def __init__(self, client, table):
+        self._client = client
+        self.table = table
+        self.path = f"/{table}"
+        self.http_method = "GET"
+        self.headers = {}
+        self.op = "select"
+        self.columns = "*"
+        self.count = None
+        self.head = False
+        self.payload = None
+        self.on_conflict = None
+        self.ignore_duplicates = False
+        self.filters = []
+        self.ordering = []
+        self.row_limit = None
+
+    def select(self, columns="*", count=None, head=False):
+        self.columns, self.count, self.head = columns, count, head
+        return self
+
+    def insert(self, rows):
+        self.op, self.http_method, self.payload = "insert", "POST", rows
+        return self
+
+    def upsert(self, rows, on_conflict=None, ignore_duplicates=False):
+        self.op, self.http_method, self.payload = "upsert", "POST", rows
+        self.on_conflict, self.ignore_duplicates = on_conflict, ignore_duplicates
+        resolution = "ignore-duplicates" if ignore_duplicates else "merge-duplicates"
+        self.headers["prefer"] = f"resolution={resolution}"
+        return self
+
+    def update(self, fields):
+        self.op, self.http_method, self.payload = "update", "PATCH", fields
+        return self
+
+    def delete(self):
+        self.op, self.http_method = "delete", "DELETE"
+        return self
+
+    def _filter(self, op, column, value):
+        self.filters.append(lambda row: _compare(op, row.get(column), value))
+        return self
+
+    def eq(self, column, value):
+        return self._filter("eq", column, value)
+
+    def neq(self, column, value):
+        return self._filter("neq", column, value)
+
+    def gt(self, column, value):
+        return self._filter("gt", column, value)
+
+    def gte(self, column, value):
+        return self._filter("gte", column, value)
+
+    def lt(self, column, value):
+        return self._filter("lt", column, value)
+
+    def lte(self, column, value):
+        return self._filter("lte", column, value)
+
+    def is_(self, column, value):
+        return self._filter("is", column, value)
+
+    def in_(self, column, values):
+        values = list(values)
+        self.filters.append(lambda row: row.get(column) in values)
+        return self
+
+    def or_(self, expression):
+        # "col.op.value,col.op.value" with string values, as PostgREST takes them
+        terms = [part.split(".", 2) for part in expression.split(",")]
+        self.filters.append(lambda row: any(_compare(op, row.get(col), value) for col, op, value in terms))
+        return self
+
+    def order(self, column, desc=False):
+        self.ordering.append((column, desc))
+        return self
+
+    def limit(self, count):
+        self.row_limit = count
+        return self
+
+    def execute(self):
+        return self._client._execute(self)
+
+class FakeRpc:
+    def __init__(self, client, name, params):
+        self._client = client
+        self.name = name
+        self.params = params
+        self.path = f"/rpc/{name}"
+        self.http_method = "POST"
+        self.headers = {}
+
+    def execute(self):
+        return self._client._execute(self)
+
+class FakeSupabase:
+    def __init__(self, latency=0.0, jitter=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.tables = defaultdict(list)
+        self.calls = Counter()
+        self._ids = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+    def rpc(self, name, params):
+        return FakeRpc(self, name, params)
+
+    def load(self, table, rows):
+        # Seeds rows directly, without latency or call counting
+        with self._lock:
+            for row in rows:
+                self._insert(table, dict(row))
+
+    def _execute(self, query):
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.random() * self.jitter)
+        with self._lock:
+            if isinstance(query, FakeRpc):
+                self.calls[(query.name, "rpc")] += 1
+                return FakeResponse(getattr(self, f"_rpc_{query.name}")(**query.params))
+            self.calls[(query.table, query.op)] += 1
+            return getattr(self, f"_run_{query.op}")(query)
+
+    # ---------- tables ----------
+    def _key(self, table, row, columns=None):
+        return tuple(row.get(c) for c in columns or PRIMARY_KEYS.get(table, ("id",)))
+
+    def _find(self, table, key, columns=None):
+        for row in self.tables[table]:
+            if self._key(table, row, columns) == key:
+                return row
+        return None
+
+    def _insert(self, table, row):
+        for column, value in DEFAULTS.get(table, {}).items():
+            row.setdefault(column, value)
+        if table in TIMESTAMPED:
+            row.setdefault("created_at", _now())
+        if PRIMARY_KEYS.get(table, ("id",)) == ("id",) and row.get("id") is None:
+            self._ids[table] += 1
+            row["id"] = self._ids[table]
+        elif "id" in row:
+            self._ids[table] = max(self._ids[table], row["id"])
+        if self._find(table, self._key(table, row)) is not None:
+            raise APIError({"code": "23505", "message": f"duplicate key value violates unique constraint on {table}"})
+        for target, column in FOREIGN_KEYS.get(table, {}).items():
+            if row.get(column) is not None and self._find(target, (row[column],)) is None:
+                raise APIError({"code": "23503", "message": f"insert on {table} violates foreign key to {target}"})
+        self.tables[table].append(row)
+        return row
+
+    def _matching(self, query):
+        rows = [row for row in self.tables[query.table] if all(f(row) for f in query.filters)]
+        for column, desc in reversed(query.ordering):
+            rows.sort(key=lambda row: (row.get(column) is None, row.get(column)), reverse=desc)
+        return rows
+
+    def _project(self, table, row, columns):
+        result = {}
+        for column in _split_columns(columns):
+            if column == "*":
+                result.update(row)
+            elif "(" in column:
+                target, inner = column[:-1].split("(", 1)
+                fk = FOREIGN_KEYS[table][target]
+                joined = self._find(target, (row.get(fk),))
+                result[target] = self._project(target, joined, inner) if joined else None
+            else:
+                result[column] = row.get(column)
+        return result
+
+    def _run_select(self, query):
+        rows = self._matching(query)
+        count = len(rows) if query.count == "exact" else None
+        if query.row_limit is not None:
+            rows = rows[:query.row_limit]
+        data = [] if query.head else [self._project(query.table, row, query.columns) for row in rows]
+        return FakeResponse(data, count)
+
+    def _run_insert(self, query):
+        rows = query.payload if isinstance(query.payload, list) else [query.payload]
+        return FakeResponse([dict(self._insert(query.table, dict(row))) for row in rows])
+
+    def _run_upsert(self, query):
+        rows = query.payload if isinstance(query.payload, list) else [query.payload]
+        columns = tuple(c.strip() for c in query.on_conflict.split(",")) if query.on_conflict else None
+        written = []
+        for row in rows:
+            existing = self._find(query.table, self._key(query.table, row, columns), columns)
+            if existing is None:
+                written.append(dict(self._insert(query.table, dict(row))))
+            elif not query.ignore_duplicates:
+                existing.update(row)
+                written.append(dict(existing))
+        return FakeResponse(written)
+
+    def _run_update(self, query):
+        rows = self._matching(query)
+        for row in rows:
+            row.update(query.payload)
+        return FakeResponse([dict(row) for row in rows])
+
+    def _run_delete(self, query):
+        rows = self._matching(query)
+        deleted = {id(row) for row in rows}
+        self.tables[query.table] = [row for row in self.tables[query.table] if id(row) not in deleted]
+        return FakeResponse([dict(row) for row in rows])
+
+    # ---------- SQL functions ----------
+    def _available(self, coupon_type):
+        now = _now()
+        return [
+            c for c in self.tables["coupons"]
+            if c["type"] == coupon_type and not c["is_used"]
+            and (c["reserved_until"] is None or c["reserved_until"] < now)
+        ]
+
+    def _use(self, coupon, user_id):
+        coupon.update(is_used=True, used_by=user_id, used_at=_now(), reserved_for=None, reserved_until=None)
+        return coupon["code"]
+
+    def _rpc_stock_summary(self):
+        return [
+            {"coupon_type": p["coupon_type"], "available": len(self._available(p["coupon_type"])), "price_1": p.get("price_1")}
+            for p in self.tables["prices"]
+        ]
+
+    def _rpc_reserve_coupons(self, p_order_id, p_user_id, p_type, p_quantity, p_ttl_seconds, p_max_open):
+        now = _now()
+        mine = {o["order_id"] for o in self.tables["orders"] if o["user_id"] == p_user_id}
+        open_orders = {
+            c["reserved_for"] for c in self.tables["coupons"]
+            if c["reserved_for"] in mine and not c["is_used"] and c["reserved_until"] > now
+        }
+        if len(open_orders) >= p_max_open:
+            return "too_many_open"
+        picked = self._available(p_type)[:p_quantity]
+        if len(picked) < p_quantity:
+            return "insufficient_stock"
+        until = _now(p_ttl_seconds)
+        for c in picked:
+            c.update(reserved_for=p_order_id, reserved_until=until)
+        return "reserved"
+
+    def _rpc_release_expired_reservations(self, p_limit):
+        now = _now()
+        expired = sorted(
+            (c for c in self.tables["coupons"] if c["reserved_until"] is not None and c["reserved_until"] < now and not c["is_used"]),
+            key=lambda c: c["reserved_until"]
+        )[:p_limit]
+        released = Counter()
+        for c in expired:
+            c.update(reserved_for=None, reserved_until=None)
+            released[c["type"]] += 1
+        return dict(released)
+
+    def _rpc_claim_coupons(self, p_type, p_quantity, p_user_id):
+        picked = self._available(p_type)[:p_quantity]
+        if len(picked) < p_quantity:
+            return None
+        return [self._use(c, p_user_id) for c in picked]
+
+    def _rpc_allocate_order(self, p_order_id):
+        o = self._find("orders", (p_order_id,))
+        if o is None:
+            return {"status": "not_found"}
+        if o["status"] != "pending":
+            return {"status": o["status"]}
+        mine = [c for c in self.tables["coupons"] if c["reserved_for"] == p_order_id and not c["is_used"]]
+        from_reservation = len(mine) >= o["quantity"]
+        released = 0
+        if from_reservation:
+            claimed = [self._use(c, o["user_id"]) for c in mine]
+        else:
+            for c in mine:
+                c.update(reserved_for=None, reserved_until=None)
+            released = len(mine)
+            claimed = self._rpc_claim_coupons(o["coupon_type"], o["quantity"], o["user_id"])
+            if claimed is None:
+                return {"status": "insufficient_stock"}
+        o["status"] = "completed"
+        return {
+            "status": "completed",
+            "codes": claimed,
+            "user_id": o["user_id"],
+            "coupon_type": o["coupon_type"],
+            "from_reservation": from_reservation,
+            "released": released
+        }
+
+    def _rpc_expire_pending_orders(self, p_max_age_seconds, p_limit):
+        cutoff = _now(-p_max_age_seconds)
+        stale = sorted(
+            (
+                o for o in self.tables["orders"]
+                if o["status"] == "pending" and o["verified_at"] is None and o["created_at"] < cutoff
+            ),
+            key=lambda o: o["created_at"]
+        )[:p_limit]
+        released, discount_uses = Counter(), Counter()
+        for o in stale:
+            o["status"] = "expired"
+            for c in self.tables["coupons"]:
+                if c["reserved_for"] == o["order_id"] and not c["is_used"]:
+                    c.update(reserved_for=None, reserved_until=None)
+                    released[c["type"]] += 1
+            if o.get("discount_code"):
+                discount_uses[o["discount_code"]] += 1
+        returned = []
+        for code, n in discount_uses.items():
+            d = self._find("discount_codes", (code,))
+            if d is not None:
+                d.update(uses=max(d["uses"] - n, 0), used=False)
+                returned.append(code)
+        return {"orders": [o["order_id"] for o in stale], "released": dict(released), "discount_codes": returned}
+
+    def _rpc_reserve_discount(self, p_code):
+        d = self._find("discount_codes", (p_code,))
+        if d is None or d["uses"] >= d["max_uses"] or (d["expires_at"] is not None and d["expires_at"] <= _now()):
+            return None
+        d["uses"] += 1
+        d["used"] = d["uses"] >= d["max_uses"]
+        return d["value"]
+
+    def _rpc_release_discount(self, p_code):
+        d = self._find("discount_codes", (p_code,))
+        if d is not None:
+            d.update(uses=max(d["uses"] - 1, 0), used=False)
+        return None
+
+# ==================== FAKE BOT API ====================
+# Answers Bot API requests the way Telegram would, closely enough for
+# python-telegram-bot to parse, and records every call as (method, params).
+# Point the application at it with TELEGRAM_API_URL=fake.base_url.
+class FakeBotApi:
+    def __init__(self, latency=0.0, jitter=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = []
+        self.port = None
+        self._server = None
+        self._message_id = 0
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    def start(self, port=0):
+        # Must be called with the event loop the bot runs on
+        app = tornado.web.Application([(r"/bot([^/]+)/(\w+)", FakeBotApiHandler, {"api": self})])
+        sockets = bind_sockets(port, address="127.0.0.1")
+        self._server = HTTPServer(app)
+        self._server.add_sockets(sockets)
+        self.port = sockets[0].getsockname()[1]
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.stop()
+
+    def calls_to(self, method):
+        return [params for name, params in self.calls if name == method]
+
+    def respond(self, token, method, params):
+        self.calls.append((method, params))
+        if method == "getMe":
+            return {"id": int(token.split(":")[0]), "is_bot": True, "first_name": "Fake Bot", "username": "fake_bot"}
+        if method.startswith(("send", "edit", "forward", "copy")) and "chat_id" in params:
+            self._message_id += 1
+            message = {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": params["chat_id"], "type": "private"},
+            }
+            if "text" in params:
+                message["text"] = str(params["text"])
+            if "caption" in params:
+                message["caption"] = str(params["caption"])
+            return message
+        return True
+
+class FakeBotApiHandler(tornado.web.RequestHandler):
+    def initialize(self, api):
+        self.api = api
+
+    async def post(self, token, method):
+        api = self.api
+        if api.latency or api.jitter:
+            await asyncio.sleep(api.latency + random.random() * api.jitter)
+        params = {}
+        for name, values in self.request.body_arguments.items():
+            value = values[-1].decode()
+            try:
+                params[name] = json.loads(value)
+            except ValueError:
+                params[name] = value
+        for name in self.request.files:
+            params[name] = "<file>"
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps({"ok": True, "result": api.respond(token, method, params)}))
@@ -0,0 +1,123 @@
+import time
+import functools
+from bisect import bisect_left
+from telegram.request import HTTPXRequest
+
+# ==================== METRICS ====================
+# Minimal Prometheus-format metrics. Recording is a dict lookup and a few
+# integer additions, so it is cheap enough for every handler call and query;
+# formatting only happens when /metrics is scraped.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, values)) + "}"
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_labels(self.labels, labels)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}
+
+    def observe(self, value, *labels):
+        series = self._values.get(labels)
+        if series is None:
+            # Per-bucket counts (made cumulative when rendered), then sum and count
+            series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                bucket_labels = _labels(self.labels + ("le",), labels + (bound,))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labels, labels)} {count}")
+        return lines
+
+class Gauge:
+    # Read from a callback at scrape time instead of being kept up to date
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {self.read()}"]
+
+_registry = []
+
+def register(metric):
+    _registry.append(metric)
+    return metric
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# ==================== BOT METRICS ====================
+handler_seconds = register(Histogram("bot_handler_seconds", "Handler latency", ("handler",)))
+handler_errors = register(Counter("bot_handler_errors_total", "Handler calls that raised", ("handler",)))
+db_seconds = register(Histogram("bot_db_seconds", "Supabase call latency", ("table", "op")))
+db_errors = register(Counter("bot_db_errors_total", "Supabase calls that failed", ("table", "op")))
+telegram_seconds = register(Histogram("bot_telegram_seconds", "Telegram Bot API call latency", ("method",)))
+
+def timed(handler):
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await handler(*args, **kwargs)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - start, name)
+    return wrapper
+
+def describe_query(query):
+    # PostgREST builders expose the request path and method: /table or /rpc/function
+    path = query.path.strip("/")
+    if path.startswith("rpc/"):
+        return path[4:], "rpc"
+    method = query.http_method
+    if method == "POST":
+        prefer = query.headers.get("prefer", "")
+        return path, "upsert" if "resolution=" in prefer else "insert"
+    return path, {"GET": "select", "PATCH": "update", "DELETE": "delete"}.get(method, method.lower())
+
+class TimedRequest(HTTPXRequest):
+    async def do_request(self, url, method, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        finally:
+            telegram_seconds.observe(time.perf_counter() - start, url.rsplit("/", 1)[-1])
@@ -0,0 +1,233 @@
+import os
+import json
+import asyncio
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from telegram.ext import BasePersistence, PersistenceInput
+import db
+
+# ==================== CONFIG ====================
+PERSISTENCE_BACKEND = os.environ.get("PERSISTENCE_BACKEND", "supabase")  # "supabase" or "sqlite"
+PERSISTENCE_SQLITE_PATH = os.environ.get("PERSISTENCE_SQLITE_PATH", "bot_state.sqlite3")
+PERSISTENCE_INTERVAL = float(os.environ.get("PERSISTENCE_INTERVAL", 5))
+# Re-read a user's data before each of their updates so instances sharing the
+# store see each other's writes. Costs a store read per update, so it is off
+# unless several instances actually share the store.
+PERSISTENCE_REFRESH = os.environ.get("PERSISTENCE_REFRESH", "0") == "1"
+
+logger = logging.getLogger(__name__)
+
+# ==================== DATABASE SCHEMA (run in Supabase) ====================
+"""
+CREATE TABLE IF NOT EXISTS bot_persistence (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    data JSONB NOT NULL,
+    PRIMARY KEY (kind, key)
+);
+"""
+
+# ==================== STORES ====================
+# A store holds rows of (kind, key, data) where kind is "user_data" or
+# "conversation:<name>" and data is a JSON string. write() receives a whole
+# batch at once; a None data means the row should be deleted.
+class SupabaseStore:
+    async def load(self):
+        result = await db.execute(db.supabase.table("bot_persistence").select("kind, key, data"))
+        return [(row["kind"], row["key"], json.dumps(row["data"], sort_keys=True)) for row in result.data]
+
+    async def load_one(self, kind, key):
+        result = await db.execute(db.supabase.table("bot_persistence").select("data").eq("kind", kind).eq("key", key))
+        return json.dumps(result.data[0]["data"], sort_keys=True) if result.data else None
+
+    async def write(self, rows):
+        upserts = [{"kind": kind, "key": key, "data": json.loads(data)} for kind, key, data in rows if data is not None]
+        deletes = {}
+        for kind, key, data in rows:
+            if data is None:
+                deletes.setdefault(kind, []).append(key)
+        if upserts:
+            await db.execute(db.supabase.table("bot_persistence").upsert(upserts))
+        for kind, keys in deletes.items():
+            await db.execute(db.supabase.table("bot_persistence").delete().eq("kind", kind).in_("key", keys))
+
+class SqliteStore:
+    def __init__(self, path):
+        # One worker thread so the connection is never used concurrently
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persistence")
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS bot_persistence ("
+            "kind TEXT NOT NULL, key TEXT NOT NULL, data TEXT NOT NULL, PRIMARY KEY (kind, key))"
+        )
+        self._conn.commit()
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _load(self):
+        return self._conn.execute("SELECT kind, key, data FROM bot_persistence").fetchall()
+
+    def _load_one(self, kind, key):
+        row = self._conn.execute("SELECT data FROM bot_persistence WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+        return row[0] if row else None
+
+    def _write(self, rows):
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO bot_persistence (kind, key, data) VALUES (?, ?, ?) "
+                "ON CONFLICT (kind, key) DO UPDATE SET data = excluded.data",
+                [row for row in rows if row[2] is not None]
+            )
+            self._conn.executemany(
+                "DELETE FROM bot_persistence WHERE kind = ? AND key = ?",
+                [(kind, key) for kind, key, data in rows if data is None]
+            )
+
+    async def load(self):
+        return await self._run(self._load)
+
+    async def load_one(self, kind, key):
+        return await self._run(self._load_one, kind, key)
+
+    async def write(self, rows):
+        await self._run(self._write, rows)
+
+# ==================== PERSISTENCE ====================
+# Persists user_data and conversation states. The application hands over the
+# data it touched every update_interval seconds; anything that serializes the
+# same as the last written version is dropped, and the rest goes out as one
+# batch per run instead of one write per update.
+#
+# With PERSISTENCE_REFRESH=1, a user's data is reloaded from the store before each of
+# their updates, so several instances can share it. Conversation states are
+# still only read at startup: PTB has no hook to refresh them, so a user's
+# conversation must stay on one instance.
+class BotPersistence(BasePersistence):
+    def __init__(self, store, update_interval=PERSISTENCE_INTERVAL, refresh=PERSISTENCE_REFRESH):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self._store = store
+        self._refresh = refresh
+        self._rows = None
+        self._written = {}
+        self._dirty = {}
+        self._pending = None
+
+    async def _load(self):
+        if self._rows is None:
+            self._rows = {}
+            for kind, key, data in await self._store.load():
+                self._rows.setdefault(kind, {})[key] = json.loads(data)
+                self._written[(kind, key)] = data
+        return self._rows
+
+    def _stage(self, kind, key, value):
+        # Ended conversations and emptied user_data are deleted rather than stored
+        data = None if value is None or value == {} else json.dumps(value, sort_keys=True)
+        if self._written.get((kind, key)) == data:
+            self._dirty.pop((kind, key), None)
+            return
+        self._dirty[(kind, key)] = data
+        if self._pending is None or self._pending.done():
+            self._pending = asyncio.get_running_loop().create_task(self._write_batch())
+
+    async def _write_batch(self, delay=0):
+        # Let the rest of this update_persistence run stage its rows first
+        await asyncio.sleep(delay)
+        written = await self._write_dirty()
+        # Rows staged while the write was in flight, or put back after it
+        # failed, would otherwise wait for some other update to stage a row
+        if self._dirty:
+            self._pending = asyncio.get_running_loop().create_task(
+                self._write_batch(0 if written else self.update_interval)
+            )
+
+    async def _write_dirty(self):
+        batch, self._dirty = self._dirty, {}
+        if not batch:
+            return True
+        try:
+            await self._store.write([(kind, key, data) for (kind, key), data in batch.items()])
+            self._written.update(batch)
+            return True
+        except Exception as e:
+            logger.error(f"Persisting {len(batch)} rows failed: {e}")
+            for item, data in batch.items():
+                self._dirty.setdefault(item, data)
+            return False
+
+    async def get_user_data(self):
+        rows = await self._load()
+        return {int(key): data for key, data in rows.get("user_data", {}).items()}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        rows = await self._load()
+        return {tuple(json.loads(key)): state for key, state in rows.get(f"conversation:{name}", {}).items()}
+
+    async def update_conversation(self, name, key, new_state):
+        self._stage(f"conversation:{name}", json.dumps(list(key)), new_state)
+
+    async def update_user_data(self, user_id, data):
+        self._stage("user_data", str(user_id), data)
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def drop_user_data(self, user_id):
+        self._stage("user_data", str(user_id), None)
+
+    async def refresh_user_data(self, user_id, user_data):
+        if not self._refresh:
+            return
+        item = ("user_data", str(user_id))
+        # Changes this instance has not written yet are newer than the store
+        local = json.dumps(user_data, sort_keys=True) if user_data else None
+        if item in self._dirty or local != self._written.get(item):
+            return
+        data = await self._store.load_one(*item)
+        if data == self._written.get(item):
+            return
+        user_data.clear()
+        if data is not None:
+            user_data.update(json.loads(data))
+        self._written[item] = data
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        if self._pending is not None:
+            await self._pending
+            # Any follow-up write it scheduled is done here instead
+            self._pending.cancel()
+        await self._write_dirty()
+
+def create_persistence():
+    if PERSISTENCE_BACKEND == "sqlite":
+        return BotPersistence(SqliteStore(PERSISTENCE_SQLITE_PATH))
+    return BotPersistence(SupabaseStore())
@@ -0,0 +1,75 @@
+import os
+import sys
+import asyncio
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# ==================== CONFIG ====================
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", 32))
+
+# ==================== UPDATE PROCESSOR ====================
+# Processes updates from different chats in parallel, at most `limit` at a
+# time, while updates from the same chat run one after another in arrival
+# order so the conversation handlers always see a chat's messages in sequence.
+#
+# The base class holds its semaphore for the whole of do_process_update, which
+# includes waiting for the chat's turn. It is therefore made effectively
+# unbounded and the real limit is applied only once an update may run, so a
+# chat with a backlog never ties up slots that other chats could use.
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, limit=UPDATE_CONCURRENCY):
+        # max_concurrent_updates reports self._limit, which sizes the base semaphore
+        self._limit = sys.maxsize
+        super().__init__(sys.maxsize)
+        self._limit = limit
+        self._slots = asyncio.Semaphore(limit)
+        self._chats = {}
+        # Updates handed over but not finished yet, including those waiting their turn
+        self.in_flight = 0
+
+    @property
+    def max_concurrent_updates(self):
+        return self._limit
+
+    @staticmethod
+    def _key(update):
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return update.effective_chat.id
+            if update.effective_user:
+                return update.effective_user.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        self.in_flight += 1
+        try:
+            await self._process(update, coroutine)
+        finally:
+            self.in_flight -= 1
+
+    async def _process(self, update, coroutine):
+        key = self._key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        # asyncio.Lock wakes waiters first-in first-out, which keeps per-chat order
+        if key not in self._chats:
+            self._chats[key] = [asyncio.Lock(), 0]
+        entry = self._chats[key]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._slots:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,142 @@
+import os
+import json
+import hmac
+import hashlib
+import logging
+from collections import deque
+import tornado.web
+from tornado.httpserver import HTTPServer
+from telegram import Update
+import db
+import metrics
+
+# ==================== CONFIG ====================
+TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN")
+# Telegram echoes this in X-Telegram-Bot-Api-Secret-Token on every delivery.
+# Derived from the bot token when unset so all instances agree on it.
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{TELEGRAM_TOKEN}".encode()).hexdigest()
+ADMIN_API_TOKEN = os.environ.get("ADMIN_API_TOKEN")
+WEBHOOK_DEDUP_SIZE = int(os.environ.get("WEBHOOK_DEDUP_SIZE", 10000))
+
+logger = logging.getLogger(__name__)
+
+# ==================== DEDUPLICATION ====================
+# Telegram redelivers an update when the webhook answers slowly. The last
+# WEBHOOK_DEDUP_SIZE update ids are remembered (a set for lookups, a deque for
+# eviction order) so a retry is acknowledged without being processed again.
+# An id is only remembered once its update is queued, so a delivery that
+# failed before that is processed when Telegram retries it.
+class RecentUpdateIds:
+    def __init__(self, size):
+        self._order = deque()
+        self._ids = set()
+        self._size = size
+        self.duplicates = 0
+
+    def seen(self, update_id):
+        if update_id in self._ids:
+            self.duplicates += 1
+            return True
+        return False
+
+    def add(self, update_id):
+        self._ids.add(update_id)
+        self._order.append(update_id)
+        if len(self._order) > self._size:
+            self._ids.discard(self._order.popleft())
+
+recent_update_ids = RecentUpdateIds(WEBHOOK_DEDUP_SIZE)
+
+# ==================== HANDLERS ====================
+class BaseHandler(tornado.web.RequestHandler):
+    def initialize(self, bot_app):
+        self.bot_app = bot_app
+
+    def write_json(self, data):
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps(data))
+
+class WebhookHandler(BaseHandler):
+    async def post(self):
+        secret = self.request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(secret, WEBHOOK_SECRET):
+            raise tornado.web.HTTPError(403)
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        update_id = data.get("update_id") if isinstance(data, dict) else None
+        if not isinstance(update_id, int) or isinstance(update_id, bool):
+            raise tornado.web.HTTPError(400)
+        if recent_update_ids.seen(update_id):
+            logger.info(f"Dropped duplicate update {update_id}")
+            self.finish()
+            return
+        try:
+            update = Update.de_json(data, self.bot_app.bot)
+        except Exception as e:
+            logger.error(f"Could not parse update {update_id}: {e}")
+            raise tornado.web.HTTPError(400)
+        # put_nowait, so nothing else runs between the duplicate check and
+        # recording the id; the update queue is unbounded
+        self.bot_app.update_queue.put_nowait(update)
+        recent_update_ids.add(update_id)
+        self.finish()
+
+class HomeHandler(BaseHandler):
+    def get(self):
+        self.finish("Bot is running!")
+
+class HealthHandler(BaseHandler):
+    def get(self):
+        if not self.bot_app.running:
+            self.set_status(503)
+        self.write_json({
+            "running": self.bot_app.running,
+            "update_queue": self.bot_app.update_queue.qsize(),
+            "duplicate_updates": recent_update_ids.duplicates
+        })
+
+class MetricsHandler(BaseHandler):
+    def get(self):
+        gauges = [
+            metrics.Gauge("bot_update_queue_depth", "Updates received but not yet picked up",
+                          self.bot_app.update_queue.qsize),
+            metrics.Gauge("bot_updates_in_flight", "Updates being processed or waiting for their chat",
+                          lambda: getattr(self.bot_app.update_processor, "in_flight", 0)),
+            metrics.Gauge("bot_duplicate_updates", "Redelivered updates dropped by the webhook",
+                          lambda: recent_update_ids.duplicates),
+        ]
+        lines = [line for gauge in gauges for line in gauge.render()]
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.finish(metrics.render() + "\n".join(lines) + "\n")
+
+class AdminHandler(BaseHandler):
+    def prepare(self):
+        # Admin endpoints are disabled unless ADMIN_API_TOKEN is configured
+        if not ADMIN_API_TOKEN:
+            raise tornado.web.HTTPError(404)
+        auth = self.request.headers.get("Authorization", "")
+        if not hmac.compare_digest(auth, f"Bearer {ADMIN_API_TOKEN}"):
+            raise tornado.web.HTTPError(401)
+
+class AdminReloadHandler(AdminHandler):
+    async def post(self):
+        db.invalidate_settings()
+        await db.price_catalog.load()
+        await db.stock.reconcile()
+        self.write_json({"prices_version": db.price_catalog.version, "stock_version": db.stock.version})
+
+# ==================== SERVER ====================
+def start_server(application, port, webhook_path):
+    app = tornado.web.Application([
+        (webhook_path, WebhookHandler, {"bot_app": application}),
+        (r"/", HomeHandler, {"bot_app": application}),
+        (r"/healthz", HealthHandler, {"bot_app": application}),
+        (r"/metrics", MetricsHandler, {"bot_app": application}),
+        (r"/admin/reload", AdminReloadHandler, {"bot_app": application}),
+    ])
+    server = HTTPServer(app, xheaders=True)
+    server.listen(port, address="0.0.0.0")
+    logger.info(f"Listening on port {port}")
+    return server